@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+#
+# Measures the throughput, latency and memory use of common pyshareflow
+# calls against the fake Shareflow API in fakeserver.py.
+#
+##
+from optparse import OptionParser
+import itertools
+import json
+import os
+import os.path
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import pyshareflow
+import fakeserver
+
+
+### Scenarios ###
+#
+# Each takes the Api and options, and returns a function that runs one
+# iteration and returns the number of items and bytes it handled.
+
+def get_posts(api, options):
+    def run():
+        posts = api.get_posts(limit=options.page_size, include_comments=True)
+        return len(posts), 0
+    return run
+
+
+def merge_post_data(api, options):
+    query = api._posts_query(options.page_size, True, None, 'created', None)
+    response = api.requester.api_query(query)
+
+    def run():
+        return len(api._merge_post_data(response)), 0
+    return run
+
+
+def upload(api, options):
+    flow_id = api.get_flows(limit=1)[0].id
+    fd, path = tempfile.mkstemp(suffix='.txt')
+    with os.fdopen(fd, 'wb') as fp:
+        fp.write(os.urandom(options.file_size))
+
+    def run():
+        api.post_files([path], flow_id, comment='Benchmark upload')
+        return 1, options.file_size
+    return run
+
+
+def download(api, options):
+    files = [file for post in api.get_posts(limit=options.page_size)
+             for file in post.files]
+    files = itertools.cycle(files)
+
+    def run():
+        return 1, len(next(files).retrieve())
+    return run
+
+
+def paginate(api, options):
+    def run():
+        count = 0
+        for post in api.iter_posts(page_size=options.page_size,
+                                   prefetch=options.prefetch):
+            count += 1
+        return count, 0
+    return run
+
+
+def search(api, options):
+    # Indexes every post, map posts included, then searches locally
+    index = pyshareflow.TextIndex()
+    for post in api.iter_posts(page_size=options.page_size,
+                               prefetch=options.prefetch):
+        index.add(post)
+    terms = itertools.cycle(['budget', 'release plan', 'customer launch',
+                             'main street'])
+
+    def run():
+        return len(index.search(next(terms))), 0
+    return run
+
+
+SCENARIOS = [get_posts, merge_post_data, upload, download, paginate, search]
+
+
+### Measurement ###
+
+def percentile(values, p):
+    """The nearest-rank percentile of sorted `values`."""
+    if not values:
+        return None
+    rank = max(0, int(round(p / 100.0 * len(values))) - 1)
+    return values[min(rank, len(values) - 1)]
+
+
+def peak_rss_kb():
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return usage // 1024
+    return usage
+
+
+def prepare(scenario, api, options, attempts=10):
+    # Setup requests can hit injected errors too
+    for attempt in xrange(attempts - 1):
+        try:
+            return scenario(api, options)
+        except Exception:
+            pass
+    return scenario(api, options)
+
+
+def measure(scenario, api, options):
+    run = prepare(scenario, api, options)
+
+    latencies = []
+    items = 0
+    bytes = 0
+    errors = 0
+    start = time.time()
+    for i in xrange(options.iterations):
+        began = time.time()
+        try:
+            count, size = run()
+        except Exception:
+            errors += 1
+            continue
+        finally:
+            latencies.append(time.time() - began)
+        items += count
+        bytes += size
+    seconds = time.time() - start
+
+    latencies.sort()
+    return {'scenario': scenario.__name__,
+            'iterations': options.iterations,
+            'errors': errors,
+            'seconds': seconds,
+            'ops_per_second': options.iterations / seconds,
+            'items_per_second': items / seconds,
+            'bytes_per_second': bytes / seconds,
+            'latency': {'min': latencies[0],
+                        'mean': sum(latencies) / len(latencies),
+                        'p50': percentile(latencies, 50),
+                        'p90': percentile(latencies, 90),
+                        'p99': percentile(latencies, 99),
+                        'max': latencies[-1]},
+            'peak_rss_kb': peak_rss_kb()}
+
+
+def start_server(options):
+    """Runs fakeserver.py in its own process, so that its memory isn't
+    counted with the client's. Returns the process and its address.
+    """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'fakeserver.py')
+    args = [sys.executable, script, '--port', '0', '--quiet',
+            '--flows', str(options.flows), '--posts', str(options.posts),
+            '--files', str(options.files),
+            '--comments', str(options.comments),
+            '--file-size', str(options.file_size),
+            '--map-every', str(options.map_every),
+            '--latency', str(options.latency),
+            '--jitter', str(options.jitter),
+            '--error-rate', str(options.error_rate),
+            '--error-status', str(options.error_status)]
+    if options.reject_gzip:
+        args.append('--reject-gzip')
+    process = subprocess.Popen(args, stdout=subprocess.PIPE)
+    address = process.stdout.readline().split()[-1]
+    return process, address
+
+
+def main():
+    names = [scenario.__name__ for scenario in SCENARIOS]
+
+    parser = OptionParser()
+    parser.add_option('-s', '--scenario', action='append', choices=names,
+                      help='Run only this scenario; may be repeated. '
+                      'One of: ' + ', '.join(names))
+    parser.add_option('-n', '--iterations', type='int', default=50,
+                      help='Iterations per scenario [default: %default]')
+    parser.add_option('--page-size', type='int', default=100,
+                      help='Posts per query [default: %default]')
+    parser.add_option('--prefetch', type='int', default=1,
+                      help='Pages fetched ahead when paginating '
+                      '[default: %default]')
+    parser.add_option('--retries', type='int', default=0,
+                      help='Retry failed requests up to N times with a '
+                      'Scheduler [default: %default]')
+    parser.add_option('--server', metavar='HOST:PORT',
+                      help='Use a fakeserver.py that is already running')
+    parser.add_option('--json', action='store_true',
+                      help='Print the results as JSON')
+    fakeserver.add_options(parser)
+    (options, args) = parser.parse_args()
+
+    process = None
+    address = options.server
+    if address is None:
+        process, address = start_server(options)
+
+    scheduler = None
+    if options.retries:
+        scheduler = pyshareflow.Scheduler(max_retries=options.retries,
+                                          retry_base=0.05)
+
+    api = pyshareflow.Api('bench.zenbe.com', 'key', server=address,
+                          scheduler=scheduler)
+    try:
+        results = [measure(scenario, api, options) for scenario in SCENARIOS
+                   if not options.scenario or
+                   scenario.__name__ in options.scenario]
+    finally:
+        api.close()
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    if options.json:
+        print json.dumps(results, indent=2)
+        return
+
+    print '{0:<16} {1:>8} {2:>10} {3:>10} {4:>9} {5:>9} {6:>9} ' \
+        '{7:>10}'.format('scenario', 'errors', 'ops/s', 'MB/s', 'p50 ms',
+                         'p90 ms', 'p99 ms', 'peak RSS')
+    for result in results:
+        latency = result['latency']
+        print '{0:<16} {1:>8d} {2:>10.1f} {3:>10.2f} {4:>9.2f} {5:>9.2f} ' \
+            '{6:>9.2f} {7:>8d}KB'.format(
+            result['scenario'], result['errors'], result['ops_per_second'],
+            result['bytes_per_second'] / (1 << 20), latency['p50'] * 1000,
+            latency['p90'] * 1000, latency['p99'] * 1000,
+            result['peak_rss_kb'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,479 @@
+#!/usr/bin/env python
+#
+# A stand-in for the Shareflow API, serving synthetic flows, posts,
+# files and comments from memory. It answers queries and updates on
+# /<domain>/shareflow/api/v2.json and file downloads on the content
+# URLs, and can add latency and errors to responses.
+#
+##
+from datetime import datetime, timedelta
+from optparse import OptionParser
+import BaseHTTPServer
+import SocketServer
+import StringIO
+import cgi
+import gzip
+import json
+import os.path
+import random
+import re
+import sys
+import threading
+import time
+import urlparse
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import pyshareflow
+
+
+EPOCH = datetime(2010, 1, 1)
+
+WORDS = ('shareflow meeting notes draft review release plan budget design '
+         'customer launch schedule update question answer thanks').split()
+
+
+### Synthetic data ###
+
+class Dataset(object):
+    """Generates a reproducible set of records shaped like API responses.
+
+    Posts are created one minute apart across `flows` flows, and each
+    has `files_per_post` files of `file_size` bytes and
+    `comments_per_post` comments. Every `map_every`th post is a map post
+    without files instead.
+    """
+
+    def __init__(self, flows=5, posts_per_flow=200, files_per_post=1,
+                 comments_per_post=2, file_size=64 * 1024, users=50,
+                 seed=0, map_every=20):
+        self.file_size = file_size
+        self.lock = threading.Lock()
+        rand = random.Random(seed)
+
+        self.users = [self.user_record(1000 + i) for i in xrange(users)]
+        self.flows = [self.flow_record(i) for i in xrange(flows)]
+        self.memberships = [
+            {'id': i, 'channel_id': flow['id'], 'user_id': 1000 + i % users,
+             'administrator': True}
+            for i, flow in enumerate(self.flows)]
+        self.invitations = []
+
+        self.posts = []
+        self.files = []
+        self.comments = []
+        for i in xrange(flows * posts_per_flow):
+            flow = self.flows[i % flows]
+            if map_every and i % map_every == map_every - 1:
+                post = self.post_record(rand, i, flow, 0, comments_per_post)
+                post['post_type'] = 'map'
+                post['content'] = json.dumps(
+                    {'address': '{0} Main Street'.format(i),
+                     'point': [42.36 + i / 1e4, -71.06]})
+            else:
+                post = self.post_record(rand, i, flow, files_per_post,
+                                        comments_per_post)
+            self.posts.append(post)
+
+        self.index()
+
+        # One compressible blob; every file's content is a slice of it
+        text = ' '.join(rand.choice(WORDS) for i in xrange(file_size // 4))
+        self.content = (text * (file_size // max(len(text), 1) + 1))[:file_size]
+
+    def index(self):
+        self.by_id = {}
+        for entity in ('users', 'flows', 'posts', 'files', 'comments'):
+            self.by_id[entity] = dict((record['id'], record)
+                                      for record in getattr(self, entity))
+
+    def timestamp(self, minutes):
+        return pyshareflow.format_timestamp(EPOCH + timedelta(minutes=minutes))
+
+    def user_record(self, id):
+        return {'id': id, 'name': 'User {0}'.format(id),
+                'email': 'user{0}@example.com'.format(id),
+                'quota': 1 << 30, 'quota_used': 0, 'quota_percentage': 0}
+
+    def flow_record(self, i):
+        return {'id': str(uuid.UUID(int=i + 1)),
+                'name': 'Flow {0}'.format(i),
+                'created_at': self.timestamp(0),
+                'updated_at': self.timestamp(0)}
+
+    def post_record(self, rand, i, flow, files_per_post, comments_per_post):
+        id = str(uuid.UUID(int=(1 << 64) + i))
+        created_at = self.timestamp(i)
+        user_id = self.users[i % len(self.users)]['id']
+
+        file_ids = []
+        for n in xrange(files_per_post):
+            file_ids.append(self.add_file(id, 'file-{0}-{1}.txt'.format(i, n),
+                                          self.file_size, created_at)['id'])
+
+        reply_ids = []
+        for n in xrange(comments_per_post):
+            comment = {'id': str(uuid.UUID(int=(2 << 64) + i * 1000 + n)),
+                       'flow_id': flow['id'], 'flow_name': flow['name'],
+                       'reply_to': id,
+                       'content': ' '.join(rand.choice(WORDS)
+                                           for w in xrange(12)),
+                       'user_id': user_id, 'created_at': created_at,
+                       'updated_at': created_at}
+            self.comments.append(comment)
+            reply_ids.append(comment['id'])
+
+        return {'id': id, 'flow_id': flow['id'], 'flow_name': flow['name'],
+                'post_type': 'file' if file_ids else 'comment',
+                'content': ' '.join(rand.choice(WORDS) for w in xrange(40)),
+                'star': None, 'user_id': user_id, 'reply_ids': reply_ids,
+                'file_ids': file_ids, 'created_at': created_at,
+                'updated_at': created_at}
+
+    def add_file(self, post_id, file_name, size, created_at):
+        id = str(uuid.uuid4())
+        record = {'id': id, 'post_id': post_id, 'file_name': file_name,
+                  'file_size': size, 'content_type': 'text/plain',
+                  'is_image': False, 'meta_data': None, 'width': None,
+                  'height': None, 'url': '/shareflow/files/{0}'.format(id),
+                  'thumbnail_url': None, 'created_at': created_at,
+                  'updated_at': created_at}
+        self.files.append(record)
+        if hasattr(self, 'by_id'):
+            self.by_id['files'][id] = record
+        return record
+
+
+### Queries and updates ###
+
+OPERATORS = {
+    'in': lambda value, arg: value in arg,
+    '<': lambda value, arg: value < arg,
+    '<=': lambda value, arg: value <= arg,
+    '>': lambda value, arg: value > arg,
+    '>=': lambda value, arg: value >= arg,
+    }
+
+# Query fields that don't share their name with a record field
+FIELDS = {'comments': {'post_id': 'reply_to'}}
+
+def matches(record, field, condition):
+    value = record.get(field)
+    if field.endswith('_at'):
+        value = pyshareflow.parse_timestamp(value)
+
+    if not isinstance(condition, dict):
+        return value == condition
+
+    for op, arg in condition.iteritems():
+        if field.endswith('_at'):
+            arg = pyshareflow.parse_timestamp(arg)
+        if op == 'in' and not isinstance(arg, (list, tuple)):
+            arg = [arg]
+        if not OPERATORS[op](value, arg):
+            return False
+    return True
+
+
+def run_query(dataset, query):
+    entity, params = query.items()[0]
+    params = dict(params)
+    include = params.pop('include', [])
+    limit = params.pop('limit', None)
+    offset = params.pop('offset', 0) or 0
+    order = params.pop('order', None)
+    keywords = params.pop('keywords', None)
+
+    records = getattr(dataset, entity)
+    fields = FIELDS.get(entity, {})
+    for name, condition in params.iteritems():
+        field = fields.get(name, name)
+        records = [r for r in records if matches(r, field, condition)]
+
+    if keywords:
+        records = [r for r in records
+                   if keywords.lower() in (r.get('content') or '').lower()]
+
+    if order:
+        field, _, direction = order.partition(' ')
+        records = sorted(records, key=lambda r: r.get(field),
+                         reverse=direction == 'desc')
+
+    records = records[offset:]
+    if limit is not None:
+        records = records[:limit]
+
+    response = {entity: records}
+    if entity == 'posts':
+        if 'files' in include:
+            response['files'] = [dataset.by_id['files'][id] for r in records
+                                 for id in r['file_ids']]
+        if 'comments' in include:
+            response['comments'] = [dataset.by_id['comments'][id]
+                                    for r in records for id in r['reply_ids']]
+    elif entity == 'flows':
+        ids = set(r['id'] for r in records)
+        if 'memberships' in include:
+            response['memberships'] = [m for m in dataset.memberships
+                                       if m['channel_id'] in ids]
+        if 'invitations' in include:
+            response['invitations'] = []
+        if 'users' in include:
+            response['users'] = dataset.users
+    return response
+
+
+def run_update(dataset, data, parts):
+    response = {}
+    now = pyshareflow.format_timestamp(datetime.utcnow().replace(
+        microsecond=0))
+
+    with dataset.lock:
+        for entity, records in data.iteritems():
+            table = dataset.by_id.setdefault(entity, {})
+            results = response.setdefault(entity, [])
+
+            for changes in records:
+                changes = dict(changes)
+                files = changes.pop('files', [])
+                id = changes.get('id') or str(uuid.uuid4())
+
+                if changes.pop('_removed', False):
+                    table.pop(id, None)
+                    results.append({'id': id, '_removed': True})
+                    continue
+
+                record = table.get(id)
+                if record is None:
+                    record = {'id': id, 'created_at': now, 'user_id': 1000,
+                              'reply_ids': [], 'file_ids': [],
+                              'post_type': 'comment'}
+                    table[id] = record
+                    getattr(dataset, entity, []).append(record)
+                record.update(changes)
+                record['updated_at'] = now
+
+                for part in files:
+                    name, size = parts[part['part_id']]
+                    file = dataset.add_file(id, name, size, now)
+                    record['file_ids'].append(file['id'])
+                    record['post_type'] = 'file'
+                    response.setdefault('files', []).append(file)
+
+                results.append(record)
+    return response
+
+
+### HTTP ###
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, *args)
+
+    def do_POST(self):
+        body = self.read_body()
+        if self.inject():
+            return
+
+        if self.headers.getheader('Content-Encoding') == 'gzip':
+            if self.server.reject_gzip:
+                self.send_json({'message': 'Unsupported Content-Encoding'},
+                               415)
+                return
+            body = gzip.GzipFile(fileobj=StringIO.StringIO(body)).read()
+
+        content_type = self.headers.getheader('Content-Type') or ''
+        if content_type.startswith('multipart/form-data'):
+            form = cgi.FieldStorage(
+                fp=StringIO.StringIO(body), headers=self.headers,
+                environ={'REQUEST_METHOD': 'POST',
+                         'CONTENT_TYPE': content_type,
+                         'CONTENT_LENGTH': str(len(body))})
+            parts = {}
+            for field in form.list or []:
+                if field.filename is not None:
+                    parts[field.name] = (field.filename, len(field.value))
+            data = json.loads(form.getfirst('data'))
+            self.send_json(run_update(self.server.dataset, data, parts))
+            return
+
+        params = json.loads(body)
+        if 'query' in params:
+            self.send_json(run_query(self.server.dataset, params['query']))
+        elif 'data' in params:
+            self.send_json(run_update(self.server.dataset, params['data'], {}))
+        else:
+            self.send_json({'message': 'Invalid request'}, 400)
+
+    def do_GET(self):
+        if self.inject():
+            return
+
+        path = urlparse.urlparse(self.path).path
+        match = re.search(r'/shareflow/files/([^/]+)$', path)
+        file = match and self.server.dataset.by_id['files'].get(match.group(1))
+        if file is None:
+            self.send_json({'message': 'Not found'}, 404)
+            return
+
+        data = self.server.dataset.content[:file['file_size']]
+        status = 200
+        headers = {'Content-Type': file['content_type']}
+
+        range = self.headers.getheader('Range')
+        if range:
+            start = int(range.split('=', 1)[1].split('-')[0])
+            headers['Content-Range'] = 'bytes {0}-{1}/{2}'.format(
+                start, len(data) - 1, len(data))
+            data = data[start:]
+            status = 206
+        elif 'gzip' in (self.headers.getheader('Accept-Encoding') or ''):
+            data = self.server.compressed(file['file_size'], data)
+            headers['Content-Encoding'] = 'gzip'
+
+        self.send(status, data, headers)
+
+    def read_body(self):
+        length = self.headers.getheader('Content-Length')
+        if length is not None:
+            return self.rfile.read(int(length))
+
+        chunks = []
+        while True:
+            size = int(self.rfile.readline().split(';')[0].strip(), 16)
+            if size == 0:
+                self.rfile.readline()
+                break
+            chunks.append(self.rfile.read(size))
+            self.rfile.readline()
+        return ''.join(chunks)
+
+    def inject(self):
+        """Sleeps for the configured latency, and maybe sends an error.
+        Returns True if an error was sent.
+        """
+        server = self.server
+        delay = server.latency + random.random() * server.jitter
+        if delay:
+            time.sleep(delay)
+
+        if server.error_rate and random.random() < server.error_rate:
+            self.send_json({'message': 'Injected error'}, server.error_status)
+            return True
+        return False
+
+    def send_json(self, data, status=200):
+        self.send(status, json.dumps(data),
+                  {'Content-Type': 'application/json; charset=utf-8'})
+
+    def send(self, status, body, headers):
+        self.send_response(status)
+        for name, value in headers.iteritems():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeShareflow(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Serves a `Dataset` over HTTP. Each response is delayed by
+    `latency` plus up to `jitter` seconds, and a fraction `error_rate`
+    of them are replaced with `error_status` errors. With `reject_gzip`,
+    gzipped request bodies are refused with a 415.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, dataset, latency=0.0, jitter=0.0,
+                 error_rate=0.0, error_status=503, reject_gzip=False,
+                 verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, Handler)
+        self.dataset = dataset
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.reject_gzip = reject_gzip
+        self.verbose = verbose
+        self._compressed = {}
+
+    @property
+    def address(self):
+        return '{0}:{1}'.format(*self.server_address)
+
+    def compressed(self, size, data):
+        if size not in self._compressed:
+            buf = StringIO.StringIO()
+            stream = gzip.GzipFile(fileobj=buf, mode='wb')
+            stream.write(data)
+            stream.close()
+            self._compressed[size] = buf.getvalue()
+        return self._compressed[size]
+
+    def start(self):
+        """Serves requests on a background thread."""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+def add_options(parser):
+    parser.add_option('--flows', type='int', default=5,
+                      help='Number of flows [default: %default]')
+    parser.add_option('--posts', type='int', default=200,
+                      help='Posts per flow [default: %default]')
+    parser.add_option('--files', type='int', default=1,
+                      help='Files per post [default: %default]')
+    parser.add_option('--comments', type='int', default=2,
+                      help='Comments per post [default: %default]')
+    parser.add_option('--file-size', type='int', default=64 * 1024,
+                      help='Bytes per file [default: %default]')
+    parser.add_option('--map-every', type='int', default=20,
+                      help='Make every Nth post a map post, or none if 0 '
+                      '[default: %default]')
+    parser.add_option('--latency', type='float', default=0.0,
+                      help='Seconds added to each response [default: %default]')
+    parser.add_option('--jitter', type='float', default=0.0,
+                      help='Up to this many more seconds [default: %default]')
+    parser.add_option('--error-rate', type='float', default=0.0,
+                      help='Fraction of responses that fail '
+                      '[default: %default]')
+    parser.add_option('--error-status', type='int', default=503,
+                      help='HTTP status of failed responses '
+                      '[default: %default]')
+    parser.add_option('--reject-gzip', action='store_true',
+                      help='Refuse gzipped request bodies')
+
+
+def create_server(options, host='127.0.0.1', port=0, verbose=False):
+    dataset = Dataset(options.flows, options.posts, options.files,
+                      options.comments, options.file_size,
+                      map_every=options.map_every)
+    return FakeShareflow((host, port), dataset, options.latency,
+                         options.jitter, options.error_rate,
+                         options.error_status, options.reject_gzip, verbose)
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-p', '--port', type='int', default=8000,
+                      help='Listen on PORT [default: %default]')
+    parser.add_option('-q', '--quiet', action='store_true',
+                      help="Don't log requests")
+    add_options(parser)
+    (options, args) = parser.parse_args()
+
+    server = create_server(options, port=options.port,
+                           verbose=not options.quiet)
+    print 'Serving a fake Shareflow API on {0}'.format(server.address)
+    sys.stdout.flush()
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
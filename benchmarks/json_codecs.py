@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+#
+# Compares the JSON backends pyshareflow can use, encoding and decoding
+# responses shaped like the ones the Shareflow API returns.
+#
+##
+from optparse import OptionParser
+import json
+import os.path
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import pyshareflow
+import fakeserver
+
+
+def payloads(options):
+    dataset = fakeserver.Dataset(flows=1, posts_per_flow=options.posts,
+                                 files_per_post=options.files,
+                                 comments_per_post=options.comments)
+    for file in dataset.files:
+        file['meta_data'] = json.dumps({'pages': 4, 'author': 'Benchmark',
+                                        'words': 1800})
+
+    query = {'posts': {'include': ['files', 'comments'], 'limit': 100,
+                       'order': 'created_at desc'}}
+    posts = fakeserver.run_query(dataset, query)
+    bulk = {'data': {'posts': [{'id': post['id'], 'flow_id': post['flow_id'],
+                                'content': post['content']}
+                               for post in dataset.posts]}}
+    return [('posts_response', posts), ('bulk_update', bulk)]
+
+
+def measure(codec, name, payload, repeat, number):
+    body = codec.dumps(payload)
+    encode = min(timeit.Timer(lambda: codec.dumps(payload)).repeat(
+        repeat, number)) / number
+    decode = min(timeit.Timer(lambda: codec.loads(body)).repeat(
+        repeat, number)) / number
+    return {'backend': codec.name,
+            'payload': name,
+            'bytes': len(body),
+            'encode_msec': encode * 1000,
+            'decode_msec': decode * 1000,
+            'encode_mb_per_second': len(body) / encode / (1 << 20),
+            'decode_mb_per_second': len(body) / decode / (1 << 20)}
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--posts', type='int', default=100,
+                      help='Posts per payload [default: %default]')
+    parser.add_option('--files', type='int', default=1,
+                      help='Files per post [default: %default]')
+    parser.add_option('--comments', type='int', default=3,
+                      help='Comments per post [default: %default]')
+    parser.add_option('-r', '--repeat', type='int', default=5,
+                      help='Take the best of N runs [default: %default]')
+    parser.add_option('-N', '--number', type='int', default=20,
+                      help='Calls per run [default: %default]')
+    parser.add_option('--json', action='store_true',
+                      help='Print the results as JSON')
+    (options, args) = parser.parse_args()
+
+    codecs = []
+    for backend in pyshareflow.JSONCodec.BACKENDS:
+        try:
+            codecs.append(pyshareflow.JSONCodec(backend))
+        except ValueError:
+            print >>sys.stderr, '{0} is not installed'.format(backend)
+
+    results = [measure(codec, name, payload, options.repeat, options.number)
+               for name, payload in payloads(options) for codec in codecs]
+
+    if options.json:
+        print json.dumps({'default': pyshareflow.CODEC.name,
+                          'results': results}, indent=2)
+        return
+
+    print 'Default backend: {0}'.format(pyshareflow.CODEC.name)
+    print '{0:<12} {1:<16} {2:>10} {3:>12} {4:>12} {5:>10} ' \
+        '{6:>10}'.format('backend', 'payload', 'bytes', 'encode ms',
+                         'decode ms', 'enc MB/s', 'dec MB/s')
+    for result in results:
+        print '{backend:<12} {payload:<16} {bytes:>10d} ' \
+            '{encode_msec:>12.3f} {decode_msec:>12.3f} ' \
+            '{encode_mb_per_second:>10.1f} ' \
+            '{decode_mb_per_second:>10.1f}'.format(**result)
+
+
+if __name__ == '__main__':
+    main()
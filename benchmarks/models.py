@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+#
+# Compares the memory use and construction speed of the pyshareflow
+# model classes with the dict-based classes they replaced.
+#
+##
+from optparse import OptionParser
+import json
+import os.path
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import pyshareflow
+
+
+def parse_time(value):
+    return pyshareflow.parse_timestamp(value)
+
+
+### The model classes before __slots__ and generated constructors ###
+
+class LegacyPost(object):
+    _VALID_ATTRIBUTES = pyshareflow.Post._VALID_ATTRIBUTES
+
+    def __init__(self, id=None, flow_id=None, flow_name=None, post_type=None,
+                 reply_ids=None, file_ids=None, user_id=-1, content=None,
+                 star=None, created_at=None, updated_at=None):
+        self.id = id
+        self.flow_id = flow_id
+        self.flow_name = flow_name
+        self.post_type = post_type
+        self.content = content
+        self.star = star
+        self.created_at = parse_time(created_at) if created_at else None
+        self.updated_at = parse_time(updated_at) if updated_at else None
+        self.reply_ids = reply_ids or []
+        self.file_ids = file_ids or []
+        self.user_id = user_id
+        self.files = list()
+        self.comments = list()
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(**dict([(str(k),v) for k,v in data.iteritems()
+                           if k in cls._VALID_ATTRIBUTES]))
+
+
+class LegacyFile(object):
+    _VALID_ATTRIBUTES = pyshareflow.File._VALID_ATTRIBUTES
+
+    def __init__(self, requester, id=None, file_name=None, file_size=0,
+                 post_id=None, content_type=None, is_image=False,
+                 meta_data=None, width=None, height=None, url=None,
+                 thumbnail_url=None, created_at=None, updated_at=None):
+        self.__requester = requester
+        self.__url = url
+        self.id = id
+        self.file_name = file_name
+        self.file_size = file_size
+        self.post_id = post_id
+        self.content_type = content_type
+        self.is_image = is_image
+        self.meta_data = None if meta_data is None else json.loads(meta_data)
+        self.width = int(width) if width else None
+        self.height = int(height) if height else None
+        self.thumbnail_url = thumbnail_url
+        self.created_at = parse_time(created_at) if created_at else None
+        self.updated_at = parse_time(updated_at) if updated_at else None
+
+    @classmethod
+    def from_json(cls, requester, data):
+        return cls(requester, **dict([(str(k),v) for k,v in data.iteritems()
+                                      if k in cls._VALID_ATTRIBUTES]))
+
+
+class LegacyComment(object):
+    _VALID_ATTRIBUTES = pyshareflow.Comment._VALID_ATTRIBUTES
+
+    def __init__(self, id=None, flow_id=None, flow_name=None, reply_to=None,
+                 content=None, user_id=-1, created_at=None, updated_at=None):
+        self.id = id
+        self.flow_id = flow_id
+        self.flow_name = flow_name
+        self.reply_to = reply_to
+        self.content = content
+        self.created_at = parse_time(created_at) if created_at else None
+        self.updated_at = parse_time(updated_at) if updated_at else None
+        self.user_id = user_id
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(**dict([(str(k),v) for k,v in data.iteritems()
+                           if k in cls._VALID_ATTRIBUTES]))
+
+
+### Records shaped like API responses ###
+
+def post_record(i):
+    return {u'id': u'6f1c1a4e-0000-0000-0000-{0:012d}'.format(i),
+            u'flow_id': u'0d7e5c1a-0000-0000-0000-000000000001',
+            u'flow_name': u'Engineering',
+            u'post_type': u'file',
+            u'content': u'Here are the notes from the meeting #{0}'.format(i),
+            u'star': None,
+            u'user_id': 1000 + i % 50,
+            u'reply_ids': [u'c-{0}-{1}'.format(i, n) for n in range(2)],
+            u'file_ids': [u'f-{0}'.format(i)],
+            u'created_at': u'2010-03-04T12:{0:02d}:{1:02d}Z'.format(
+                i // 60 % 60, i % 60),
+            u'updated_at': u'2010-03-05T08:{0:02d}:{1:02d}Z'.format(
+                i // 60 % 60, i % 60)}
+
+
+def file_record(i):
+    return {u'id': u'f-{0}'.format(i),
+            u'post_id': u'6f1c1a4e-0000-0000-0000-{0:012d}'.format(i),
+            u'file_name': u'notes-{0}.pdf'.format(i),
+            u'file_size': 204800 + i,
+            u'content_type': u'application/pdf',
+            u'is_image': False,
+            u'meta_data': u'{"pages": 4}',
+            u'width': None,
+            u'height': None,
+            u'url': u'/shareflow/files/f-{0}'.format(i),
+            u'thumbnail_url': None,
+            u'created_at': u'2010-03-04T12:00:00Z',
+            u'updated_at': u'2010-03-04T12:00:00Z'}
+
+
+def comment_record(i):
+    return {u'id': u'c-{0}'.format(i),
+            u'flow_id': u'0d7e5c1a-0000-0000-0000-000000000001',
+            u'flow_name': u'Engineering',
+            u'reply_to': u'6f1c1a4e-0000-0000-0000-{0:012d}'.format(i),
+            u'content': u'Thanks!',
+            u'user_id': 1000 + i % 50,
+            u'created_at': u'2010-03-04T12:00:00Z',
+            u'updated_at': u'2010-03-04T12:00:00Z'}
+
+
+def instance_size(obj):
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+
+def measure(name, build, records, repeat):
+    timer = timeit.Timer(lambda: [build(r) for r in records])
+    seconds = min(timer.repeat(repeat, 1))
+    objects = [build(r) for r in records]
+    return {'model': name,
+            'records': len(records),
+            'usec_per_object': seconds / len(records) * 1e6,
+            'bytes_per_object': instance_size(objects[0])}
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-n', '--records', type='int', default=20000,
+                      help='Build N objects per run [default: %default]')
+    parser.add_option('-r', '--repeat', type='int', default=5,
+                      help='Take the best of N runs [default: %default]')
+    parser.add_option('--json', action='store_true',
+                      help='Print the results as JSON')
+    (options, args) = parser.parse_args()
+
+    posts = [post_record(i) for i in xrange(options.records)]
+    files = [file_record(i) for i in xrange(options.records)]
+    comments = [comment_record(i) for i in xrange(options.records)]
+
+    results = [
+        measure('LegacyPost', LegacyPost.from_json, posts, options.repeat),
+        measure('Post', pyshareflow.Post.from_json, posts, options.repeat),
+        measure('LegacyFile', lambda r: LegacyFile.from_json(None, r),
+                files, options.repeat),
+        measure('File', lambda r: pyshareflow.File.from_json(None, r),
+                files, options.repeat),
+        measure('LegacyComment', LegacyComment.from_json, comments,
+                options.repeat),
+        measure('Comment', pyshareflow.Comment.from_json, comments,
+                options.repeat),
+        ]
+
+    if options.json:
+        print json.dumps(results, indent=2)
+        return
+
+    print '{0:<15} {1:>15} {2:>17}'.format('model', 'usec/object',
+                                          'bytes/object')
+    for result in results:
+        print '{model:<15} {usec_per_object:>15.2f} ' \
+            '{bytes_per_object:>17d}'.format(**result)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,9 +3,7 @@
 # Uses the GData API to post a document to Shareflow
 #
 ##
-from datetime import datetime
 from optparse import OptionParser
-from xml.utils import iso8601
 import gdata.docs
 import gdata.docs.service
 import gdata.spreadsheet.service
@@ -58,8 +56,8 @@ if feed.entry:
 
     # Get the relevant document attributes
     link = entry.GetAlternateLink().href
-    timestamp = iso8601.parse(entry.updated.text)
-    updated = datetime.fromtimestamp(timestamp).strftime("%b %m %Y, %I:%M %p")
+    timestamp = pyshareflow.parse_timestamp(entry.updated.text)
+    updated = timestamp.strftime("%b %m %Y, %I:%M %p UTC")
     modified_by_name = entry.lastModifiedBy.name.text
     modified_by_email = entry.lastModifiedBy.email.text
     title = entry.title.text
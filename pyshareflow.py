@@ -1,30 +1,75 @@
-from datetime import datetime
-from xml.utils import iso8601
+from datetime import datetime, timedelta
 import StringIO
-import gzip
+import array
+import calendar
+import collections
+import contextlib
+import errno
+import hashlib
+import heapq
 import httplib
+import inspect
 import json
+import math
 import mimetools
 import mimetypes
+import mmap
 import os.path
+import Queue
+import random
 import re
+import select
+import socket
+import sqlite3
+import stat
+import sys
+import tempfile
+import threading
+import time
 import urllib
 import urllib2
+import urlparse
 import uuid
+import weakref
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 VERSION=2
 SERVER='api.zenbe.com'
 
-# urllib2.install_opener(
-#     urllib2.build_opener(
-#         urllib2.ProxyHandler({'http': 'http://127.0.0.1:8080',
-#                               'https': 'http://127.0.0.1:8080'})))
-
 
 class Api(object):
     def __init__(self, user_domain, key, version=VERSION, use_ssl=False,
-                 server=SERVER):
-        self.requester = Requester(server, user_domain, key, version, use_ssl)
+                 server=SERVER, pool_size=4, pool_idle_timeout=30,
+                 max_workers=4, cache=None, scheduler=None, hooks=None,
+                 compress_threshold=None, compress_level=6, codec=None,
+                 file_cache=None, identity_map=None, user_ttl=60,
+                 text_index=None):
+        if cache is True:
+            cache = ResponseCache()
+        if identity_map is True:
+            identity_map = IdentityMap()
+        if text_index is True:
+            text_index = TextIndex()
+
+        pool = ConnectionPool(pool_size, pool_idle_timeout)
+        self.requester = Requester(server, user_domain, key, version, use_ssl,
+                                   pool, cache, scheduler, compress_threshold,
+                                   compress_level, codec, file_cache)
+        self.requester.hooks.extend(hooks or [])
+        self.workers = WorkerPool(max_workers)
+        self.identity_map = identity_map
+        self.user_ttl = user_ttl
+        self._users = LRUCache(max_entries=10000)
+        self.text_index = text_index
+
+    def close(self):
+        self.workers.shutdown()
+        self.requester.close()
 
     @classmethod
     def get_auth_token(cls, username, password, user_domain):
@@ -35,6 +80,66 @@ class Api(object):
         return None
         
 
+    def bulk(self, max_records=100, max_bytes=512 * 1024):
+        """Returns a `Batch` that sends many writes in a few requests."""
+        return Batch(self, max_records, max_bytes)
+
+    def sync(self, store, page_size=100, prefetch=1):
+        """Brings a local `SQLiteStore` mirror up to date.
+
+        Only flows, posts and comments updated since the last sync are
+        fetched, including those updated in the same second as the last
+        record seen, which are applied again. Records marked `_removed`
+        are deleted from the mirror. Returns the number of records
+        applied per entity.
+        """
+        if store.api is None:
+            store.api = self
+
+        counts = {}
+        for entity in SQLiteStore.ENTITIES:
+            counts[entity] = self._sync_entity(store, entity, page_size,
+                                               prefetch)
+        return counts
+
+    def export_columns(self, flow_id=None, include_comments=True,
+                       before=None, after=None, page_size=100, prefetch=1):
+        """Fetches posts, with their files and comments, into
+        `ColumnTable`s keyed 'posts', 'files' and 'comments'.
+
+        Records are written straight from the responses into the
+        columns, without creating model objects. Requires NumPy.
+        """
+        entities = ['posts', 'files']
+        if include_comments:
+            entities.append('comments')
+        writers = _column_writers(entities)
+
+        def build_query(cursor, inclusive):
+            query = self._posts_query(page_size, include_comments, flow_id,
+                                      'created', None)
+            self._add_time_params(query, 'created', cursor, after, inclusive)
+            return query
+
+        pages = self._keyset_pages(build_query, 'posts', 'created', before,
+                                   min(page_size, 100), lambda data: [data])
+
+        for data in self._iter_prefetched(pages, prefetch):
+            # Pages can repeat the files and comments of posts already seen
+            ids = set(post['id'] for post in data['posts'])
+            for record in data['posts']:
+                writers['posts'].append_record(record)
+            for record in data.get('files') or []:
+                if record.get('post_id') in ids:
+                    writers['files'].append_record(record)
+            for record in data.get('comments') or []:
+                if include_comments and record.get('reply_to') in ids:
+                    writers['comments'].append_record(record)
+
+        tables = _column_tables(writers)
+        _fill_file_owners(tables['files'], tables['posts'])
+        return tables
+
 ##### User Methods #####
 
     def get_users(self, flow_id=None, offset=None, limit=50):
@@ -57,10 +162,96 @@ class Api(object):
         users = None
 
         if 'users' in response:
-            users = [User.from_json(user) for user in response['users']]
+            users = [self._load(User, user) for user in response['users']]
 
         return users or []
 
+    def iter_users(self, flow_id=None, page_size=50, prefetch=0):
+        """Yields every user, `page_size` users at a time.
+
+        Users have no timestamps to page on, so this pages by offset.
+        """
+        def pages():
+            offset = 0
+            while True:
+                users = self.get_users(flow_id, offset, page_size)
+                if users:
+                    yield users
+                if len(users) < page_size:
+                    return
+                offset += len(users)
+
+        return self._iter_prefetched(pages(), prefetch)
+
+    def get_users_by_ids(self, user_ids, chunk_size=100):
+        """Gets many users with as few queries as possible.
+
+        Users fetched in the last `user_ttl` seconds are taken from a
+        cache. The rest are queried `chunk_size` ids at a time, the
+        chunks concurrently on the worker pool. Returns a dict of the
+        users found, by id.
+        """
+        users = {}
+        missing = []
+        seen = set([None, -1])
+        now = time.time()
+        for id in user_ids:
+            if id in seen:
+                continue
+            seen.add(id)
+            entry = self._users.get(id)
+            if entry is not None and entry[0] > now:
+                users[id] = entry[1]
+            else:
+                missing.append(id)
+
+        chunks = [missing[i:i + chunk_size]
+                  for i in xrange(0, len(missing), chunk_size)]
+        if len(chunks) > 1:
+            results = self.workers.map(self._query_users, chunks)
+        else:
+            results = [self._query_users(chunk) for chunk in chunks]
+
+        expires = time.time() + self.user_ttl
+        for result in results:
+            for user in result:
+                users[user.id] = user
+                if self.user_ttl:
+                    self._users.set(user.id, (expires, user), 1)
+        return users
+
+    def _query_users(self, ids):
+        query = Query('users')
+        query.id = {'in': ids}
+        query.limit = len(ids)
+
+        response = self.requester.api_query(query)
+        return [self._load(User, user) for user in response.get('users') or []]
+
+    def _resolve_users(self, models):
+        """Sets `user` on models and their comments from their `user_id`."""
+        models = list(models)
+        comments = [comment for model in models
+                    for comment in getattr(model, 'comments', ())]
+
+        users = self.get_users_by_ids(model.user_id
+                                      for model in models + comments)
+        for model in models + comments:
+            model.user = users.get(model.user_id)
+        return models
+
+    def _resolve_users_stream(self, posts, batch_size=100):
+        batch = []
+        for post in posts:
+            batch.append(post)
+            if len(batch) == batch_size:
+                for post in self._resolve_users(batch):
+                    yield post
+                batch = []
+
+        for post in self._resolve_users(batch):
+            yield post
+
     def get_user(self, user_id):
         query = Query('users')
         query.id = user_id
@@ -70,7 +261,7 @@ class Api(object):
         user = None
 
         if 'users' in response:
-            user = [User.from_json(user) for user in response['users']][0]
+            user = [self._load(User, user) for user in response['users']][0]
 
         return user
 
@@ -91,13 +282,7 @@ class Api(object):
         if order_by not in ['updated', 'created']:
             raise ValueError("order_by must be one of 'updated', 'created'")
 
-        query = Query('flows')
-        query.include = ['memberships','invitations']
-        query.limit = min(limit, 100)
-        query.order = '{0}_at desc'.format(order_by)
-
-        if name:
-            query.name = name
+        query = self._flows_query(limit, order_by, name)
 
         if offset:
             query.offset = offset
@@ -106,6 +291,26 @@ class Api(object):
 
         return self._merge_flow_data(response)
 
+    def iter_flows(self,
+                   page_size=100,
+                   order_by='created',
+                   name=None,
+                   before=None,
+                   after=None,
+                   prefetch=0):
+        """Yields every flow, newest first. See `iter_posts`."""
+        if order_by not in ['updated', 'created']:
+            raise ValueError("order_by must be one of 'updated', 'created'")
+
+        def build_query(cursor, inclusive):
+            query = self._flows_query(page_size, order_by, name)
+            self._add_time_params(query, order_by, cursor, after, inclusive)
+            return query
+
+        pages = self._keyset_pages(build_query, 'flows', order_by, before,
+                                   min(page_size, 100), self._merge_flow_data)
+        return self._iter_prefetched(pages, prefetch)
+
     def get_flow_by_name(self, name):
         flows = self.get_flows(name=name)
 
@@ -119,9 +324,9 @@ class Api(object):
         update.name = name
         update.id = str(uuid.uuid4())
 
-        response = self.requester.api_update(update)
+        response = self.requester.api_update(update, retryable=True)
 
-        return Flow.from_json(response['flows'][0])
+        return self._load(Flow, response['flows'][0])
 
     def update_flow_name(self, name, flow_id):
         update = Update('flows')
@@ -130,7 +335,7 @@ class Api(object):
 
         response = self.requester.api_update(update)
 
-        return Flow.from_json(response['flows'][0])
+        return self._load(Flow, response['flows'][0])
 
     def delete_flow(self, flow_id):
         update = Update('flows')
@@ -149,7 +354,7 @@ class Api(object):
 
         response = self.requester.api_update(update)
 
-        return Flow.from_json(response['flows'][0])
+        return self._load(Flow, response['flows'][0])
 
     def delete_invitations(self, flow_id, invitees):
         if isinstance(invitees, str):
@@ -161,7 +366,7 @@ class Api(object):
 
         response = self.requester.api_update(update)
 
-        return Flow.from_json(response['flows'][0])
+        return self._load(Flow, response['flows'][0])
 
 ##### Post Methods #####
         
@@ -173,7 +378,9 @@ class Api(object):
                   offset=None,
                   before=None,
                   after=None,
-                  search_term=None):
+                  search_term=None,
+                  stream=False,
+                  resolve_users=False):
 
         if order_by not in ['updated', 'created']:
             raise ValueError("order_by must be one of 'updated', 'created'")
@@ -181,28 +388,122 @@ class Api(object):
         if offset and (before or after):
             raise InvalidRequest("offset cannot be specified with before or after param")
 
-        query = Query('posts')
-        query.order = '{0}_at desc'.format(order_by)
-        query.limit = min(limit, 100)
-        query.include = ['files']
+        query = self._posts_query(limit, include_comments, flow_id, order_by,
+                                  search_term)
         
         if offset:
             query.offset = max(offset, 0)
 
-        if flow_id:
-            query.flow_id = {'in': flow_id}
+        self._add_time_params(query, order_by, before, after)
 
-        if search_term:
-            query.keywords = search_term
+        if stream:
+            posts = self._stream_post_data(self.requester.api_query_stream(query),
+                                           query.include)
+            if resolve_users:
+                return self._resolve_users_stream(posts)
+            return posts
 
-        if include_comments:
-            query.include.append('comments')
+        response = self.requester.api_query(query)
 
-        self._add_time_params(query, order_by, before, after)
+        posts = self._merge_post_data(response)
+        if resolve_users:
+            self._resolve_users(posts)
+        return posts
 
-        response = self.requester.api_query(query)
+    def iter_posts(self,
+                   page_size=100,
+                   include_comments=True,
+                   flow_id=None,
+                   order_by='created',
+                   before=None,
+                   after=None,
+                   search_term=None,
+                   prefetch=0):
+        """Yields every matching post, newest first.
+
+        Pages are fetched `page_size` posts at a time, using the
+        `created_at` (or `updated_at`) of the last post seen as the
+        cursor for the next page. With `prefetch` > 0, up to that many
+        pages are fetched in the background ahead of the caller.
+        """
+        if order_by not in ['updated', 'created']:
+            raise ValueError("order_by must be one of 'updated', 'created'")
+
+        def build_query(cursor, inclusive):
+            query = self._posts_query(page_size, include_comments, flow_id,
+                                      order_by, search_term)
+            self._add_time_params(query, order_by, cursor, after, inclusive)
+            return query
+
+        pages = self._keyset_pages(build_query, 'posts', order_by, before,
+                                   min(page_size, 100), self._merge_post_data)
+        return self._iter_prefetched(pages, prefetch)
+
+    def get_posts_multi(self,
+                        flow_ids,
+                        limit=30,
+                        include_comments=True,
+                        order_by='created',
+                        before=None,
+                        after=None,
+                        search_term=None,
+                        shard_size=10):
+        """Gets the newest posts across many flows.
+
+        The flows are split into shards of `shard_size` which are queried
+        concurrently on the worker pool. Their results are merged into the
+        same order `get_posts` returns, and no more pages are fetched once
+        `limit` posts have been merged. `limit` may exceed 100.
+        """
+        if order_by not in ['updated', 'created']:
+            raise ValueError("order_by must be one of 'updated', 'created'")
+
+        flow_ids = list(flow_ids)
+        field = '{0}_at'.format(order_by)
+        page_size = min(limit, 100)
+
+        def shard_pages(shard):
+            def build_query(cursor, inclusive):
+                query = self._posts_query(page_size, include_comments, shard,
+                                          order_by, search_term)
+                self._add_time_params(query, order_by, cursor, after,
+                                      inclusive)
+                return query
+
+            return self._keyset_pages(build_query, 'posts', order_by, before,
+                                      page_size, self._merge_post_data)
+
+        shards = [shard_pages(flow_ids[i:i + shard_size])
+                  for i in xrange(0, len(flow_ids), shard_size)]
+        buffers = self.workers.map(lambda pages: next(pages, []), shards)
+
+        heap = []
+        for index, page in enumerate(buffers):
+            if page:
+                heap.append((_Descending(getattr(page[0], field)), index, 0))
+        heapq.heapify(heap)
+
+        posts = []
+        while heap and len(posts) < limit:
+            key, index, position = heapq.heappop(heap)
+            posts.append(buffers[index][position])
+
+            position += 1
+            if position == len(buffers[index]):
+                if len(posts) == limit:
+                    break
+                buffers[index] = next(shards[index], [])
+                position = 0
 
-        return self._merge_post_data(response)
+            if position < len(buffers[index]):
+                post = buffers[index][position]
+                heapq.heappush(heap, (_Descending(getattr(post, field)),
+                                      index, position))
+
+        for pages in shards:
+            pages.close()
+
+        return posts
 
     def search(self,
                search_term,
@@ -211,8 +512,12 @@ class Api(object):
                flow_id=None, 
                order_by='created',
                before=None,
-               after=None):
+               after=None,
+               local=False):
 
+        if local:
+            return self._search_local(search_term, limit, include_comments,
+                                      flow_id, order_by, before, after)
 
         return self.get_posts(search_term=search_term,
                               limit=limit,
@@ -222,33 +527,108 @@ class Api(object):
                               before=before,
                               after=after)
 
-    def post_files(self, file_paths, flow_id, comment=None):
-        if isinstance(file_paths, str):
-            file_paths = [file_paths]
-
-        if len(file_paths) == 0:
-            raise ValueError("file_paths must not be empty")
-
-        update = Update('posts')
-        update.flow_id = flow_id
-        update.id = str(uuid.uuid4())
+    def _search_local(self, search_term, limit, include_comments, flow_id,
+                      order_by, before, after):
+        if self.text_index is None:
+            raise ValueError("local search needs a text_index")
+
+        results = self.text_index.search(search_term, limit, flow_id,
+                                         order_by, before, after)
+        posts = dict((id, self.text_index.posts.get(id))
+                     for id, score in results)
+
+        # Posts no longer in use, or found by an index loaded from disk,
+        # are fetched again
+        missing = [id for id, post in posts.iteritems() if post is None]
+        if missing:
+            query = self._posts_query(len(missing), include_comments, None,
+                                      order_by, None)
+            query.id = {'in': missing}
+            for post in self._merge_post_data(self.requester.api_query(query)):
+                posts[post.id] = post
+
+        return [posts[id] for id, score in results if posts[id] is not None]
+
+    def post_files(self, file_paths, flow_id, comment=None, progress=None):
+        file_paths = self._file_list(file_paths)
+        update = self._files_update(str(uuid.uuid4()), flow_id, comment)
+        return self._send_files(update, file_paths, progress, True)
+
+    def add_files_to_post(self, file_paths, post_id, progress=None):
+        file_paths = self._file_list(file_paths)
+        return self._send_files(self._files_update(post_id), file_paths,
+                                progress)
+
+    def upload_files(self, file_paths, flow_id=None, post_id=None,
+                     comment=None, group_size=5, retries=2, progress=None,
+                     retry_added=False):
+        """Uploads many files to one post, a group at a time.
+
+        Unless `post_id` is given, a post is created in `flow_id` with
+        the first `group_size` files. The other groups are attached with
+        `add_files_to_post`, concurrently on the worker pool.
+        `progress(source, bytes_sent, size)` is called as each file is
+        sent.
+
+        The group creating the post is sent again up to `retries` times
+        after a transient error, which is safe since the post's id is
+        generated here. The other groups are not retried unless
+        `retry_added` is true: a group that timed out or got a 5xx may
+        already have been attached, and sending it again attaches its
+        files twice.
+
+        Returns the post with the created files, in the order given. If
+        any group still fails, raises `UploadError`.
+        """
+        file_paths = self._file_list(file_paths)
+        groups = [file_paths[i:i + group_size]
+                  for i in xrange(0, len(file_paths), group_size)]
+        results = [None] * len(groups)
+        failed = []
+        post = None
+
+        if post_id is None:
+            post_id = str(uuid.uuid4())
+            try:
+                post = results[0] = self._send_group(
+                    lambda: self._files_update(post_id, flow_id, comment),
+                    groups[0], retries, progress, True)
+            except Exception as error:
+                raise UploadError(error, None, [(groups[0], error)])
+            first = 1
+        else:
+            first = 0
 
-        if comment:
-            update.content = comment
+        added_retries = retries if retry_added else 0
+        futures = [self.workers.submit(self._send_group,
+                                       lambda: self._files_update(post_id),
+                                       group, added_retries, progress)
+                   for group in groups[first:]]
 
-        response = self.requester.api_update_with_files(update, file_paths)
+        for index, future in enumerate(futures, first):
+            try:
+                results[index] = future.result()
+                post = post or results[index]
+            except Exception as error:
+                failed.append((groups[index], error))
 
-    def add_files_to_post(self, file_paths, post_id):
-        if isinstance(file_paths, str):
-            file_paths = [file_paths]
+        files = []
+        seen = set()
+        for result in results:
+            for file in (result.files if result else []):
+                if file.id not in seen:
+                    seen.add(file.id)
+                    files.append(file)
 
-        if len(file_paths) == 0:
-            raise ValueError("file_paths must not be empty")
+        if post is not None:
+            post.files = files
+            post.file_ids = post.file_ids + [file.id for file in files
+                                             if file.id not in post.file_ids]
 
-        update = Update('posts')
-        update.id = post_id
+        if failed:
+            raise UploadError(failed[0][1], post, failed)
 
-        response = self.requester.api_update_with_files(update, file_paths)
+        return post
 
     def create_post(self, flow_id, content):
         update = Update('posts')
@@ -256,9 +636,11 @@ class Api(object):
         update.content = content
         update.id = str(uuid.uuid4())
 
-        response = self.requester.api_update(update)
+        response = self.requester.api_update(update, retryable=True)
 
-        return Post.from_json(response['posts'][0])
+        post = self._create_post(response['posts'][0])
+        self._reindex_post(post)
+        return post
 
     def update_post(self, post_id, content=None, file_paths=None):
         update = Update('posts')
@@ -273,13 +655,14 @@ class Api(object):
         response = None
 
         if file_paths:
-            if isinstance(file_paths, str):
-                file_paths = [file_paths]
+            file_paths = self._file_list(file_paths)
             response = self.requester.api_update_with_files(update, file_paths)
         else:
             response = self.requester.api_update(update)
-            
-        return Post.from_json(response['posts'][0])
+
+        post = self._create_post(response['posts'][0])
+        self._reindex_post(post)
+        return post
 
     def delete_post(self, post_id):
         update = Update('posts')
@@ -288,9 +671,12 @@ class Api(object):
 
         response = self.requester.api_update(update)
 
+        if self.text_index is not None:
+            self.text_index.remove(post_id)
+
 ##### Comment Methods #####
 
-    def get_comments(self, post_id):
+    def get_comments(self, post_id, resolve_users=False):
         query = Query('comments')
         query.post_id = post_id
         
@@ -299,19 +685,91 @@ class Api(object):
         comments = None
 
         if 'comments' in response:
-            comments = [Comment.from_json(comment) for comment in response['comments']]
+            comments = [self._load(Comment, comment) for comment in response['comments']]
+
+        if comments and resolve_users:
+            self._resolve_users(comments)
 
         return comments or []
 
+    def get_comments_for_posts(self, post_ids, after=None, chunk_size=50,
+                               resolve_users=False):
+        """Gets the comments on many posts.
+
+        Posts are queried `chunk_size` at a time with a `post_id` 'in'
+        filter, the chunks concurrently on the worker pool. With `after`,
+        only comments updated since then are fetched. Returns a dict of
+        comment lists, oldest first, for each post id given.
+        """
+        post_ids = list(post_ids)
+        chunks = [post_ids[i:i + chunk_size]
+                  for i in xrange(0, len(post_ids), chunk_size)]
+
+        def fetch(chunk):
+            return list(self.iter_comments(post_id={'in': chunk},
+                                           order_by='updated', after=after))
+
+        if len(chunks) > 1:
+            results = self.workers.map(fetch, chunks)
+        else:
+            results = [fetch(chunk) for chunk in chunks]
+
+        comments = dict((post_id, []) for post_id in post_ids)
+        for result in results:
+            for comment in result:
+                comments.setdefault(comment.reply_to, []).append(comment)
+
+        for thread in comments.itervalues():
+            thread.sort(key=lambda comment: comment.created_at)
+
+        if resolve_users:
+            self._resolve_users(comment for result in results
+                                for comment in result)
+
+        return comments
+
+    def iter_comments(self,
+                      post_id=None,
+                      flow_id=None,
+                      page_size=100,
+                      order_by='created',
+                      before=None,
+                      after=None,
+                      prefetch=0):
+        """Yields every matching comment, newest first. See `iter_posts`."""
+        if order_by not in ['updated', 'created']:
+            raise ValueError("order_by must be one of 'updated', 'created'")
+
+        def build_query(cursor, inclusive):
+            query = Query('comments')
+            query.order = '{0}_at desc'.format(order_by)
+            query.limit = min(page_size, 100)
+
+            if post_id:
+                query.post_id = post_id
+
+            if flow_id:
+                query.flow_id = {'in': flow_id}
+
+            self._add_time_params(query, order_by, cursor, after, inclusive)
+            return query
+
+        def merge(data):
+            return [self._load(Comment, comment) for comment in data['comments']]
+
+        pages = self._keyset_pages(build_query, 'comments', order_by, before,
+                                   min(page_size, 100), merge)
+        return self._iter_prefetched(pages, prefetch)
+
     def create_comment(self, post_id, content):
         update = Update('comments')
         update.post_id = post_id
         update.id = str(uuid.uuid4())
         update.content = content
 
-        response = self.requester.api_update(update)
+        response = self.requester.api_update(update, retryable=True)
 
-        return Comment.from_json(response['comments'][0])
+        return self._load(Comment, response['comments'][0])
 
     def delete_comment(self, comment_id):
         update = Update('comments')
@@ -322,15 +780,256 @@ class Api(object):
 
 ##### Internal Methods #####
 
-    def _add_time_params(self, query, order_by, before, after):
-        # TODO Allow inclusive, exclusive
+    def _files_update(self, post_id, flow_id=None, comment=None):
+        update = Update('posts')
+        update.id = post_id
+
+        if flow_id:
+            update.flow_id = flow_id
+
+        if comment:
+            update.content = comment
+
+        return update
+
+    def _send_files(self, update, file_paths, progress=None,
+                    retryable=False):
+        # Only the update creating the post has a client-generated id;
+        # adding files to an existing post is never retried
+        response = self.requester.api_update_with_files(
+            update, file_paths, progress=progress, retryable=retryable)
+        posts = self._merge_post_data(response) if response.get('posts') \
+            else []
+        return posts[0] if posts else None
+
+    def _send_group(self, build_update, sources, retries, progress,
+                    retryable=False):
+        # File objects are read again from where they started. Other
+        # streams can't be sent twice.
+        offsets = []
+        for source in sources:
+            if isinstance(source, tuple):
+                source = source[1]
+            if isinstance(source, basestring):
+                continue
+            try:
+                offsets.append((source, source.tell()))
+            except (AttributeError, IOError):
+                retries = 0
+
+        # The scheduler already retries updates that are safe to repeat
+        if retryable and self.requester.scheduler is not None:
+            retries = 0
+
+        attempt = 0
+        while True:
+            try:
+                return self._send_files(build_update(), sources, progress,
+                                        retryable)
+            except Exception as error:
+                if attempt >= retries or not Scheduler._is_transient(error):
+                    raise
+                attempt += 1
+                for fp, offset in offsets:
+                    fp.seek(offset)
+
+    def _file_list(self, file_paths):
+        # A single path or file object may be passed in place of a list
+        if isinstance(file_paths, basestring) or hasattr(file_paths, 'read'):
+            file_paths = [file_paths]
+
+        if len(file_paths) == 0:
+            raise ValueError("file_paths must not be empty")
+
+        return file_paths
+
+    def _sync_entity(self, store, entity, page_size, prefetch):
+        since = high_water = store.get_high_water(entity)
+
+        def build_query(cursor, inclusive):
+            if entity == 'posts':
+                query = self._posts_query(page_size, True, None, 'updated',
+                                          None)
+            elif entity == 'flows':
+                query = self._flows_query(page_size, 'updated', None)
+            else:
+                query = Query(entity)
+                query.order = 'updated_at desc'
+                query.limit = min(page_size, 100)
+
+            # Timestamps have one-second resolution, so records updated in
+            # the same second as the mark may not have been seen yet.
+            # Applying the ones that were again does no harm.
+            self._add_time_params(query, 'updated', cursor, since, inclusive,
+                                  after_inclusive=True)
+            return query
+
+        pages = self._keyset_pages(build_query, entity, 'updated', None,
+                                   min(page_size, 100), lambda data: [data])
+
+        count = 0
+        for data in self._iter_prefetched(pages, prefetch):
+            count += len(data[entity])
+            high_water = store.apply(entity, data, high_water)
+
+        store.set_high_water(entity, high_water)
+        return count
+
+    def _posts_query(self, limit, include_comments, flow_id, order_by,
+                     search_term):
+        query = Query('posts')
+        query.order = '{0}_at desc'.format(order_by)
+        query.limit = min(limit, 100)
+        query.include = ['files']
+
+        if flow_id:
+            query.flow_id = {'in': flow_id}
+
+        if search_term:
+            query.keywords = search_term
+
+        if include_comments:
+            query.include.append('comments')
+
+        return query
+
+    def _flows_query(self, limit, order_by, name):
+        query = Query('flows')
+        query.include = ['memberships','invitations']
+        query.limit = min(limit, 100)
+        query.order = '{0}_at desc'.format(order_by)
+
+        if name:
+            query.name = name
+
+        return query
+
+    def _keyset_pages(self, build_query, entity, order_by, before, page_size,
+                      merge):
+        """Generates pages of models, using timestamps as the cursor.
+
+        Each page asks for records at or before the timestamp of the last
+        record seen, so records sharing that timestamp across the page
+        boundary are not skipped; the ones already returned are dropped.
+        When a whole page shares one timestamp, the records at it are
+        paged through by descending id before moving past it. Paging
+        stops if a query can't move the cursor forward.
+        """
+        field = '{0}_at'.format(order_by)
+        cursor, inclusive = before, False
+        # The id cursor while paging through one timestamp
+        tie, tie_id = None, None
+        seen = set()
+        state = None
+
+        while True:
+            if tie is None:
+                query = build_query(cursor, inclusive)
+            else:
+                query = build_query(tie, True)
+                stamp = self._format_time(tie)
+                setattr(query, field, {'>=': stamp, '<=': stamp})
+                query.order = 'id desc'
+                if tie_id is not None:
+                    query.id = {'<': tie_id}
+
+            response = self.requester.api_query(query)
+            records = response.get(entity) or []
+            fresh = [r for r in records if r['id'] not in seen]
+
+            if fresh:
+                response = dict(response)
+                response[entity] = fresh
+                yield merge(response)
+
+            if tie is not None:
+                if len(records) < page_size:
+                    # Done with this timestamp; continue past it
+                    cursor, inclusive = tie, False
+                    tie, tie_id = None, None
+                    seen = set()
+                else:
+                    seen.update(r['id'] for r in records)
+                    tie_id = records[-1]['id']
+            else:
+                if len(records) < page_size:
+                    return
+
+                last = records[-1][field]
+                if records[0][field] == last:
+                    tie, tie_id = last, None
+                if last != cursor:
+                    seen = set()
+                seen.update(r['id'] for r in records if r[field] == last)
+                cursor, inclusive = last, True
+
+            # A server that ignores the cursor would repeat pages forever
+            if (cursor, inclusive, tie, tie_id) == state:
+                return
+            state = (cursor, inclusive, tie, tie_id)
+
+    def _iter_prefetched(self, pages, prefetch):
+        """Yields the models from `pages`.
+
+        With `prefetch` > 0 the pages are produced by a background thread
+        that stays up to `prefetch` pages ahead of the caller.
+        """
+        if prefetch <= 0:
+            for page in pages:
+                for item in page:
+                    yield item
+            return
+
+        queue = Queue.Queue(prefetch)
+        done = threading.Event()
+        context = _call_context()
+
+        def produce():
+            _set_call_context(context)
+            try:
+                for page in pages:
+                    if not self._put_page(queue, done, (page, None)):
+                        return
+                self._put_page(queue, done, (None, None))
+            except Exception:
+                self._put_page(queue, done, (None, sys.exc_info()))
+
+        worker = threading.Thread(target=produce)
+        worker.daemon = True
+        worker.start()
+
+        try:
+            while True:
+                page, error = queue.get()
+                if error:
+                    raise error[0], error[1], error[2]
+                if page is None:
+                    return
+                for item in page:
+                    yield item
+        finally:
+            done.set()
+
+    def _put_page(self, queue, done, item):
+        while not done.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def _add_time_params(self, query, order_by, before, after,
+                         inclusive=False, after_inclusive=False):
         time_param = {}
 
         if before:
-            time_param.update({'<': iso8601.tostring(before)})
+            op = '<=' if inclusive else '<'
+            time_param.update({op: self._format_time(before)})
 
         if after:
-            time_param.update({'>' : iso8601.tostring(after)})
+            op = '>=' if after_inclusive else '>'
+            time_param.update({op: self._format_time(after)})
 
         if len(time_param) > 0:
             if order_by == 'updated':
@@ -338,12 +1037,18 @@ class Api(object):
             else:
                 query.created_at = time_param
 
+    def _format_time(self, value):
+        # Timestamps taken straight from a response are passed through
+        if isinstance(value, basestring):
+            return value
+        return format_timestamp(value)
+
     def _merge_flow_data(self, data):
         if len(data['flows']) == 0:
             return []
 
         # This list preserves server order requested by the user
-        flows = [Flow.from_json(flow) for flow in data['flows']]
+        flows = [self._load(Flow, flow) for flow in data['flows']]
         # Index the flows to merge the data
         flows_idx = dict((flow.id, flow) for flow in flows)
 
@@ -352,10 +1057,13 @@ class Api(object):
             for m in data['memberships']:
                 if m['administrator']:
                     flow = flows_idx[m['channel_id']]
-                    flow.owner = m['user_id']
+                    flow.owner_id = m['user_id']
                          
         # Add invitations
         if 'invitations' in data:
+            # Shared flows may already hold invitations from earlier
+            for flow in flows:
+                flow.invitations = []
             for i in data['invitations']:
                 flow = flows_idx[i['channel_id']]
                 flow.invitations.append(Invitation(i['id'], i['email_address']))
@@ -374,21 +1082,107 @@ class Api(object):
         comments = None
 
         if 'files' in data:
-            files = dict((file['id'], File.from_json(self.requester, file)) for file in data['files'])
+            files = dict((file['id'], self._load(File, self.requester, file)) for file in data['files'])
 
         if 'comments' in data:
-            comments = dict((comment['id'], Comment.from_json(comment)) for comment in data['comments'])
+            comments = dict((comment['id'], self._load(Comment, comment)) for comment in data['comments'])
  
         for post in posts:
-            if files:
-                post.files = [files[id] for id in post.file_ids]
+            if files is not None:
+                post.files = [files[id] for id in post.file_ids
+                              if id in files]
 
-            if comments:
-                post.comments = [comments[id] for id in post.reply_ids]
+            if comments is not None:
+                post.comments = [comments[id] for id in post.reply_ids
+                                 if id in comments]
 
+        if self.text_index is not None:
+            self.text_index.add_posts(posts)
 
         return posts
         
+    def _stream_post_data(self, members, include):
+        """Yields posts from a streamed response in server order.
+
+        A post is yielded as soon as the files and comments it refers to
+        have arrived, whatever order the response lists them in.
+        """
+        files = {}
+        comments = {}
+        pending = collections.deque()
+        wait_files = 'files' in include
+        wait_comments = 'comments' in include
+
+        def ready(data):
+            if wait_files:
+                for id in data.get('file_ids') or ():
+                    if id not in files:
+                        return False
+            if wait_comments:
+                for id in data.get('reply_ids') or ():
+                    if id not in comments:
+                        return False
+            return True
+
+        def build(data):
+            post = self._create_post(data)
+            if wait_files:
+                post.files = [files.pop(id) for id in post.file_ids
+                              if id in files]
+            if wait_comments:
+                post.comments = [comments.pop(id) for id in post.reply_ids
+                                 if id in comments]
+            if self.text_index is not None:
+                self.text_index.add(post)
+            return post
+
+        for key, item in members:
+            if key == 'posts':
+                pending.append(item)
+            elif key == 'files':
+                files[item['id']] = self._load(File, self.requester, item)
+            elif key == 'comments':
+                comments[item['id']] = self._load(Comment, item)
+            else:
+                continue
+
+            while pending and ready(pending[0]):
+                yield build(pending.popleft())
+
+        while pending:
+            yield build(pending.popleft())
+
+    def _load(self, cls, *args):
+        if self.identity_map is None:
+            return cls.from_json(*args)
+        return self.identity_map.load(cls, *args)
+
+    def _create_model(self, entity, data):
+        if entity == 'posts':
+            return self._create_post(data)
+        if entity == 'comments':
+            return self._load(Comment, data)
+        if entity == 'flows':
+            return self._load(Flow, data)
+        if entity == 'users':
+            return self._load(User, data)
+        if entity == 'files':
+            return self._load(File, self.requester, data)
+        return data
+
+    def _reindex_post(self, post):
+        """Updates the text index with a post a write returned. Write
+        responses leave out comments and files, so those of the copy
+        already indexed are kept.
+        """
+        if self.text_index is None:
+            return
+        indexed = self.text_index.posts.get(post.id)
+        if indexed is not None and indexed is not post:
+            post.comments = post.comments or indexed.comments
+            post.files = post.files or indexed.files
+        self.text_index.add(post)
+
     def _create_post(self, post_data):
         type = post_data['post_type']
         types = {
@@ -403,9 +1197,64 @@ class Api(object):
             }
 
         if not type in types:
-            return Post.from_json(post_data)
+            return self._load(Post, post_data)
+
+        return self._load(types[type], post_data)
+
+class AsyncApi(object):
+    """Runs `Api` calls concurrently, returning a `Future` for each.
+
+    Every public `Api` method is available and takes the same arguments,
+    plus an optional `timeout` in seconds for the requests of that call.
+    Calls run on a bounded pool of `max_workers` threads which share one
+    connection pool, so any number of calls can be outstanding at once.
+    The `iter_*` methods are returned as plain iterators. Other keyword
+    arguments, such as `scheduler`, `hooks` or `cache`, are passed to
+    the `Api`.
+    """
+
+    def __init__(self, user_domain, key, version=VERSION, use_ssl=False,
+                 server=SERVER, pool_size=16, pool_idle_timeout=30,
+                 max_workers=16, timeout=None, **api_options):
+        self.api = Api(user_domain, key, version, use_ssl, server, pool_size,
+                       pool_idle_timeout, **api_options)
+        self.workers = WorkerPool(max_workers)
+        self.timeout = timeout
+
+    def __getattr__(self, name):
+        method = getattr(self.api, name)
+
+        if name.startswith('_') or name.startswith('iter_') or \
+                not callable(method):
+            return method
+
+        def call(*args, **kwargs):
+            return self.submit(method, *args, **kwargs)
+
+        call.__name__ = name
+        call.__doc__ = method.__doc__
+        return call
+
+    def submit(self, fn, *args, **kwargs):
+        """Runs `fn` on the worker pool and returns its `Future`."""
+        timeout = kwargs.pop('timeout', self.timeout)
+        return self.workers.submit(self._call, fn, timeout, args, kwargs)
+
+    def retrieve(self, file, timeout=None):
+        return self.submit(file.retrieve, timeout=timeout)
+
+    def retrieve_to(self, file, path_or_fileobj, resume=False, timeout=None):
+        return self.submit(file.retrieve_to, path_or_fileobj, resume=resume,
+                           timeout=timeout)
+
+    def close(self):
+        self.workers.shutdown()
+        self.api.close()
+
+    def _call(self, fn, timeout, args, kwargs):
+        with self.api.requester.timeout(timeout):
+            return fn(*args, **kwargs)
 
-        return types[type].from_json(post_data)
 
 class Query(dict):
     def __init__(self, entity):
@@ -428,117 +1277,459 @@ class Update(dict):
         self['data'] = {entity: [{}]}
 
     def __getattr__(self, name):
-       val = self['data'][self.__dict__['entity']][0].get(name)
+       val = self['data'][self.__dict__['entity']][-1].get(name)
        if not val:
            raise AttributeError("Invalid attribute: {0}".format(name))
        return val
 
     def __setattr__(self, name, val):
-        self['data'][self.__dict__['entity']][0][name] = val
+        self['data'][self.__dict__['entity']][-1][name] = val
+
+    def new_record(self):
+        """Starts another record. Attributes set after this apply to it."""
+        self['data'][self.__dict__['entity']].append({})
+
+
+class Batch(object):
+    """Collects writes and sends them in as few updates as possible.
+
+    Records are grouped by entity and sent flows first, then posts, then
+    comments, so comments may refer to posts created in the same batch.
+    An update holds at most `max_records` records and roughly
+    `max_bytes` of JSON. Each write returns the id of its record, and
+    `results` maps those ids to the models the server returned (None for
+    deletes). The batch is sent when used as a context manager exits.
+    """
+    ENTITY_ORDER = ['flows', 'posts', 'comments']
+
+    def __init__(self, api, max_records=100, max_bytes=512 * 1024):
+        self.api = api
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.results = {}
+        self._records = {}
+        self._removed = set()
+        # Ids generated here for new records
+        self._created = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.flush()
+
+    def __len__(self):
+        return sum(len(records) for records in self._records.values())
+
+    def create_flow(self, name):
+        return self._create('flows', name=name)
+
+    def update_flow_name(self, name, flow_id):
+        return self._add('flows', id=flow_id, name=name)
+
+    def delete_flow(self, flow_id):
+        return self._add('flows', id=flow_id, _removed=True)
+
+    def create_post(self, flow_id, content):
+        return self._create('posts', flow_id=flow_id, content=content)
+
+    def update_post(self, post_id, content):
+        return self._add('posts', id=post_id, content=content)
+
+    def delete_post(self, post_id):
+        return self._add('posts', id=post_id, _removed=True)
+
+    def create_comment(self, post_id, content):
+        return self._create('comments', post_id=post_id, content=content)
+
+    def delete_comment(self, comment_id):
+        return self._add('comments', id=comment_id, _removed=True)
+
+    @property
+    def pending(self):
+        """The records not sent yet, by entity."""
+        return dict((entity, list(records))
+                    for entity, records in self._records.iteritems()
+                    if records)
+
+    def flush(self):
+        """Sends the pending records and returns `results`.
+
+        Records leave the batch once the update carrying them succeeds.
+        If an update fails, `BatchError` is raised and the records not
+        sent stay queued, so `flush` can be called again.
+        """
+        entities = [e for e in Batch.ENTITY_ORDER if e in self._records]
+        entities.extend(e for e in self._records if e not in entities)
+
+        for entity in entities:
+            records = self._records[entity]
+            while records:
+                chunk = next(self._chunks(records))
+                try:
+                    self._send(entity, chunk)
+                except Exception as error:
+                    raise BatchError(error, self.pending), None, \
+                        sys.exc_info()[2]
+                del records[:len(chunk)]
+            del self._records[entity]
+
+        return self.results
+
+    def _create(self, entity, **record):
+        record['id'] = str(uuid.uuid4())
+        self._created.add(record['id'])
+        return self._add(entity, **record)
+
+    def _add(self, entity, **record):
+        self._records.setdefault(entity, []).append(record)
+        if record.get('_removed'):
+            self._removed.add(record['id'])
+        self.results[record['id']] = None
+        return record['id']
+
+    def _chunks(self, records):
+        chunk, size = [], 0
+        for record in records:
+            record_size = len(self.api.requester.codec.dumps(record))
+            if chunk and (len(chunk) >= self.max_records or
+                          size + record_size > self.max_bytes):
+                yield chunk
+                chunk, size = [], 0
+            chunk.append(record)
+            size += record_size
+
+        if chunk:
+            yield chunk
+
+    def _send(self, entity, records):
+        update = Update(entity)
+        for i, record in enumerate(records):
+            if i:
+                update.new_record()
+            for name, value in record.iteritems():
+                setattr(update, name, value)
+
+        # Only updates that just create records are safe to repeat
+        retryable = all(record['id'] in self._created for record in records)
+        response = self.api.requester.api_update(update, retryable=retryable)
+
+        for data in response.get(entity) or []:
+            if data['id'] in self._removed:
+                continue
+            model = self.api._create_model(entity, data)
+            if entity == 'posts':
+                self.api._reindex_post(model)
+            self.results[data['id']] = model
+
+        if entity == 'posts' and self.api.text_index is not None:
+            for record in records:
+                if record.get('_removed'):
+                    self.api.text_index.remove(record['id'])
 
 class Requester(object):
     USER_AGENT='pyshareflow APIv{0}'.format(VERSION)
+    CHUNK_SIZE = 64 * 1024
 
     def __init__(self, server, user_domain, key=None, version=VERSION, 
-                 use_ssl=False):
+                 use_ssl=False, pool=None, cache=None, scheduler=None,
+                 compress_threshold=None, compress_level=6, codec=None,
+                 file_cache=None):
         protocol = 'https' if use_ssl else 'http'         
         self.base_url = "{0}://{1}/{2}".format(protocol, server, user_domain)
         self.api_url = "{0}/shareflow/api/v{1}.json".format(self.base_url, version)
         self.auth_url = "{0}/shareflow/api/v{1}/auth.json".format(self.base_url, version)
         self.key = key
+        self.pool = pool or ConnectionPool()
+        self.cache = cache
+        self.scheduler = scheduler
+        self.codec = codec or CODEC
+        self.file_cache = file_cache
+        self.hooks = []
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+        # None until the server accepts or rejects a gzipped body
+        self.gzip_supported = None
+        self._compression = {'requests_compressed': 0,
+                             'request_bytes_saved': 0}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @property
+    def stats(self):
+        stats = self.pool.get_stats()
+        with self._lock:
+            stats.update(self._compression)
+        return stats
+
+    def add_hook(self, hook):
+        """Calls `hook(record)` with a `RequestRecord` after each request."""
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def close(self):
+        self.pool.close()
+
+    @contextlib.contextmanager
+    def timeout(self, timeout):
+        """Overrides the socket timeout of requests made by this thread,
+        and by the worker pool and prefetch threads it starts meanwhile.
+        """
+        previous = getattr(_calling, 'timeout', None)
+        _calling.timeout = timeout
+        try:
+            yield
+        finally:
+            _calling.timeout = previous
 
     def get_auth_token(self, username, password):
         return self._request({'login': username, 'password': password}, 
                              self.auth_url)
 
-    def api_update(self, update, timeout=60):
+    def api_update(self, update, timeout=60, retryable=False):
+        """Sends an update. Pass `retryable=True` only when every record
+        creates a new record under an id generated by the client, so that
+        sending it twice can't apply it twice.
+        """
         update['key'] = self.key
-        return self._request(update, self.api_url, timeout)
-
-    def api_update_with_files(self, update, file_paths, timeout=300):
-        return self._request_with_files(update, file_paths, self.api_url,
-                                        timeout)
+        response = self._call(
+            lambda: self._request(update, self.api_url, timeout),
+            retryable, 'update', update.entity)
+        if self.cache is not None:
+            self.cache.invalidate(update.entity)
+        return response
+
+    def api_update_with_files(self, update, file_paths, timeout=300,
+                              progress=None, retryable=False):
+        # Files given as paths can be sent again; streams can't
+        retryable = retryable and \
+            all(isinstance(path, basestring) for path in file_paths)
+        response = self._call(
+            lambda: self._request_with_files(update, file_paths, self.api_url,
+                                             timeout, progress),
+            retryable, 'upload', update.entity)
+        if self.cache is not None:
+            self.cache.invalidate(update.entity)
+        return response
 
     def api_query(self, query, timeout=60):
         query['key'] = self.key
-        return self._request(query, self.api_url, timeout)
+        if self.cache is not None and self.cache.caches(query.entity):
+            return self._call(lambda: self._cached_query(query, timeout),
+                              True, 'query', query.entity)
+        return self._call(lambda: self._request(query, self.api_url, timeout),
+                          True, 'query', query.entity)
+
+    def api_query_stream(self, query, timeout=60):
+        """Sends a query and yields the members of the response as they
+        are decoded. See `iter_json_members`.
+        """
+        query['key'] = self.key
+        response = self._call(
+            lambda: self._open('POST', self.api_url, self.codec.dumps(query),
+                               self._json_headers(), timeout),
+            True, 'query', query.entity)
+        return iter_json_members(self.iter_response(response))
 
     def content_request(self, path, timeout=300):
-        req = urllib2.Request(self.create_url(path), 
-                              headers={'User-Agent': Requester.USER_AGENT,
-                                       'Accept-Encoding': 'gzip'})
-        
-        response = urllib2.urlopen(req, timeout=timeout)
-        return self._read_response(response)
+        return self._call(
+            lambda: self._read_response(self._open_content(path, 0, timeout)),
+            True, 'content')
+
+    def content_stream(self, path, offset=0, timeout=300):
+        return self._call(lambda: self._open_content(path, offset, timeout),
+                          True, 'content')
+
+    def iter_response(self, response, chunk_size=CHUNK_SIZE):
+        record = getattr(self._local, 'record', None)
+        decoder = None
+        if response.info().getheader('Content-Encoding') == 'gzip':
+            decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+        try:
+            while True:
+                data = response.read(chunk_size)
+                if not data:
+                    break
+
+                if decoder is None:
+                    if record is not None:
+                        record.decoded_bytes += len(data)
+                    yield data
+                    continue
+
+                # Bound the output of each step so a highly compressed
+                # body can't expand into one huge string.
+                while data:
+                    start = time.time()
+                    chunk = decoder.decompress(data, chunk_size)
+                    if record is not None:
+                        record.timings['decode'] += time.time() - start
+                        record.decoded_bytes += len(chunk)
+                    if chunk:
+                        yield chunk
+                    data = decoder.unconsumed_tail
+
+            if decoder is not None:
+                chunk = decoder.flush()
+                if record is not None:
+                    record.decoded_bytes += len(chunk)
+                if chunk:
+                    yield chunk
+        finally:
+            response.close()
 
     def create_url(self, path):
         return "{0}{1}?key={2}".format(self.base_url, path, self.key)
 
-    def _request(self, params, url, timeout=60, requestobj=None):
+    def _request(self, params, url, timeout=60, body=None, headers=None):
+        if body is None:
+            body = self.codec.dumps(params)
+            if self._compresses(body):
+                return self._request_gzipped(url, body, timeout, headers)
 
-        req = requestobj or urllib2.Request(url, json.dumps(params),
-                                            {'User-Agent': Requester.USER_AGENT,
-                                             'Accept-Encoding': 'gzip',
-                                             'Accept': 'application/json',
-                                             'Content-Type': 'application/json; charset=UTF-8'})
-        try:
-            response = urllib2.urlopen(req, timeout=timeout)
-        except urllib2.HTTPError as error:
-            self._check_error(error)
-            raise error
+        response = self._open('POST', url, body, self._json_headers(headers),
+                              timeout)
 
         data = self._read_response(response)
             
         return data
 
-    def _request_with_files(self, update, file_paths, url, timeout=300):
+    def _compresses(self, body):
+        return self.compress_threshold is not None and \
+            self.gzip_supported is not False and \
+            len(body) >= self.compress_threshold
 
-        boundary = mimetools.choose_boundary()
-        crlf = '\r\n'
-        tmp = []
-        tmp.append('--' + boundary)
-        tmp.append('Content-Disposition: form-data; name="key"')
-        tmp.append('Content-Type: application/json; charset=UTF-8')
-        tmp.append('')
-        tmp.append(str(self.key))
+    def _request_gzipped(self, url, body, timeout, headers):
+        compressor = zlib.compressobj(self.compress_level, zlib.DEFLATED,
+                                      16 + zlib.MAX_WBITS)
+        compressed = compressor.compress(body) + compressor.flush()
+        if len(compressed) >= len(body):
+            return self._request(None, url, timeout, body, headers)
 
-        files = []
-        
-        for path in file_paths:
-            id = 'file_' + str(uuid.uuid4())
+        gzip_headers = {'Content-Encoding': 'gzip'}
+        gzip_headers.update(headers or {})
+
+        try:
+            data = self._request(None, url, timeout, compressed, gzip_headers)
+        except (InvalidRequest, urllib2.HTTPError) as error:
+            # Until a gzipped body has been accepted, a 400 or 415 may
+            # mean the server can't read them. Send it again as is, and
+            # stop compressing if that works.
+            if self.gzip_supported or \
+                    getattr(error, 'code', httplib.BAD_REQUEST) not in \
+                    (httplib.BAD_REQUEST, httplib.UNSUPPORTED_MEDIA_TYPE):
+                raise
+            data = self._request(None, url, timeout, body, headers)
+            self.gzip_supported = False
+            return data
+
+        self.gzip_supported = True
+        with self._lock:
+            self._compression['requests_compressed'] += 1
+            self._compression['request_bytes_saved'] += \
+                len(body) - len(compressed)
+        return data
+
+    def _open_content(self, path, offset, timeout):
+        headers = {'User-Agent': Requester.USER_AGENT,
+                   'Accept-Encoding': 'gzip'}
+
+        if offset:
+            # A range applies to the encoded body, and a gzip stream
+            # can't be decompressed from the middle.
+            headers['Accept-Encoding'] = 'identity'
+            headers['Range'] = 'bytes={0}-'.format(offset)
+
+        return self._open('GET', self.create_url(path), None, headers,
+                          timeout)
+
+    def _call(self, fn, retryable, kind, entity=None):
+        if self.hooks:
+            return self._call_recorded(fn, retryable, kind, entity)
+        if self.scheduler is None:
+            return fn()
+        return self.scheduler.call(fn, retryable)
+
+    def _call_recorded(self, fn, retryable, kind, entity):
+        record = RequestRecord(kind, entity, _current_method())
+
+        def attempt():
+            record.attempts += 1
+            return fn()
+
+        self._local.record = record
+        start = time.time()
+        try:
+            if self.scheduler is None:
+                return attempt()
+            return self.scheduler.call(attempt, retryable)
+        except Exception as error:
+            record.error = error
+            if isinstance(error, urllib2.HTTPError):
+                record.status = error.code
+            raise
+        finally:
+            record.total = time.time() - start
+            self._local.record = None
+            for hook in self.hooks:
+                hook(record)
+
+    def _json_headers(self, headers=None):
+        request_headers = {'User-Agent': Requester.USER_AGENT,
+                           'Accept-Encoding': 'gzip',
+                           'Accept': 'application/json',
+                           'Content-Type': 'application/json; charset=UTF-8'}
+        if headers:
+            request_headers.update(headers)
+        return request_headers
+
+    def _open(self, method, url, body, headers, timeout):
+        timeout = getattr(_calling, 'timeout', None) or timeout
+        record = getattr(self._local, 'record', None)
+        response = self.pool.urlopen(method, url, body, headers, timeout,
+                                     record)
+
+        if record is not None:
+            record.status = response.status
+
+        if response.status >= 400:
+            # Error bodies are small; read them now so the connection
+            # goes straight back to the pool.
+            error = urllib2.HTTPError(url, response.status, response.reason,
+                                      response.msg,
+                                      StringIO.StringIO(response.read()))
+            self._check_error(error)
+            raise error
+
+        return response
 
-            tmp.append('--' + boundary)
-            tmp.append('Content-Disposition: form-data; name="{0}"; filename="{1}"'
-                       .format(id, os.path.basename(path)))
-            tmp.append('Content-Type: {0}'.format(
-                    mimetypes.guess_type(path)[0] or 'application/octet-stream'))
-            tmp.append('')
-            tmp.append(open(path, 'r').read())
+    def _request_with_files(self, update, file_paths, url, timeout=300,
+                            progress=None):
+        encoder = MultipartEncoder()
+        encoder.add_field('key', str(self.key))
 
+        files = []
+
+        for source in file_paths:
+            id = 'file_' + str(uuid.uuid4())
+            encoder.add_file(id, source,
+                             progress=self._file_progress(progress, source))
             files.append({'part_id': id})
 
         update.files = files
-        tmp.append('--' + boundary)
-        tmp.append('Content-Disposition: form-data; name="data"')
-        tmp.append('Content-Type: application/json; charset=UTF-8')
-        tmp.append('')
-        tmp.append(json.dumps(update['data']))
-
-        tmp.append('--' + boundary + '--')
-        tmp.append('')
-        
-        body = crlf.join(tmp)
-        content_type = 'multipart/form-data; boundary={0}'.format(boundary)
+        encoder.add_field('data', self.codec.dumps(update['data']))
 
-        request = urllib2.Request(url, body,
-                                  {'User-Agent': Requester.USER_AGENT,
-                                   'Accept-Encoding': 'gzip',
-                                   'Accept': 'application/json',
-                                   'Content-Type': content_type,
-                                   'Content-Length': str(len(body))})
+        return self._request(None, url, timeout, encoder,
+                             {'Content-Type': encoder.content_type})
 
-        return self._request(None, None, timeout=timeout, requestobj=request)
-                       
+    def _file_progress(self, progress, source):
+        if progress is None:
+            return None
+        return lambda sent, size: progress(source, sent, size)
 
     def _check_error(self, error):
         exception_map = { httplib.BAD_REQUEST : InvalidRequest,
@@ -557,23 +1748,2494 @@ class Requester(object):
             msg = error.message
         
         # Raise a custom exception
-        raise exception_map[response.code](msg)
+        raise exception_map[error.code](msg)
+
+    def _cached_query(self, query, timeout):
+        # Only the standard library can sort keys, which the key needs
+        key = json.dumps(query, sort_keys=True)
+        entry = self.cache.get(key)
+
+        if entry is not None and entry.is_fresh():
+            return entry.data
+
+        headers = {}
+        if entry is not None:
+            if entry.etag:
+                headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                headers['If-Modified-Since'] = entry.last_modified
+
+        response = self._open('POST', self.api_url, key,
+                              self._json_headers(headers), timeout)
+
+        if response.status == httplib.NOT_MODIFIED and entry is not None:
+            response.read()
+            self.cache.refresh(key, entry)
+            return entry.data
+
+        body = ''.join(self.iter_response(response))
+        data = self._decode_body(response, body)
+
+        include = query['query'][query.entity].get('include') or []
+        self.cache.store(key, query.entity, include, data, len(body),
+                         response.getheader('ETag'),
+                         response.getheader('Last-Modified'))
+        return data
 
     def _read_response(self, response):
-        fp = None
-        if response.info().getheader('Content-Encoding') == 'gzip':
-            fp = gzip.GzipFile(fileobj=StringIO.StringIO(response.read()))
+        body = ''.join(self.iter_response(response))
+        return self._decode_body(response, body)
+
+    def _decode_body(self, response, body):
+        if response.info().getheader('Content-Type').find('application/json') == -1:
+            return body
+
+        record = getattr(self._local, 'record', None)
+        if record is None:
+            return self.codec.loads(body)
+
+        start = time.time()
+        data = self.codec.loads(body)
+        record.timings['decode'] += time.time() - start
+        return data
+
+##### JSON Codec #####
+
+class JSONCodec(object):
+    """Encodes and decodes JSON with the fastest available backend.
+
+    `backend` names one of `BACKENDS`. By default the first that can be
+    imported is used; simplejson only counts if its C speedups are
+    built. The standard library `json` module is the fallback. `dumps`
+    returns a `str` and `loads` takes the `str` read off the wire, so
+    bodies are never copied into `unicode` first.
+    """
+    BACKENDS = ['ujson', 'simplejson', 'json']
+
+    def __init__(self, backend=None):
+        if backend is None:
+            for name in JSONCodec.BACKENDS:
+                module = self._import(name, require_speedups=True)
+                if module is not None:
+                    break
+        else:
+            module = self._import(backend)
+            if module is None:
+                raise ValueError("JSON backend {0} isn't available".format(
+                    backend))
+
+        self.name = module.__name__
+        self.loads = module.loads
+        if self.name == 'ujson':
+            self.dumps = module.dumps
+        else:
+            self.dumps = module.JSONEncoder(separators=(',', ':')).encode
+
+    def __repr__(self):
+        return 'JSONCodec({0!r})'.format(self.name)
+
+    def _import(self, name, require_speedups=False):
+        try:
+            module = __import__(name)
+            if require_speedups and name == 'simplejson':
+                __import__('simplejson._speedups')
+            return module
+        except ImportError:
+            return None
+
+
+CODEC = JSONCodec()
+
+def set_json_backend(name=None):
+    """Switches the default codec to the backend `name` (or the fastest
+    available one). Requesters created earlier keep their codec.
+    """
+    global CODEC
+    CODEC = JSONCodec(name)
+    return CODEC
+
+def _decode_json(value):
+    return CODEC.loads(value)
+
+##### Streaming JSON #####
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_DECODER = json.JSONDecoder()
+
+def iter_json_members(chunks):
+    """Incrementally decodes a JSON object from an iterable of strings.
+
+    Yields `(key, item)` for each element of an array member of the
+    object, and `(key, value)` for any other member, as soon as enough
+    input has arrived to decode it. Only one element is held decoded at
+    a time.
+    """
+    return _JSONStream(chunks).members()
+
+
+class _JSONStream(object):
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def members(self):
+        self._expect('{')
+        if self._peek() == '}':
+            return
+
+        while True:
+            key = self._value()
+            self._expect(':')
+
+            if self._peek() == '[':
+                self.pos += 1
+                if self._peek() == ']':
+                    self.pos += 1
+                else:
+                    while True:
+                        yield key, self._value()
+                        if self._expect(',]') == ']':
+                            break
+            else:
+                yield key, self._value()
+
+            if self._expect(',}') == '}':
+                return
+
+    def _fill(self):
+        try:
+            chunk = next(self.chunks)
+        except StopIteration:
+            self.eof = True
+            return False
+
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def _peek(self):
+        while True:
+            self.pos = _WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                raise ValueError("Unexpected end of JSON input")
+
+    def _expect(self, chars):
+        char = self._peek()
+        if char not in chars:
+            raise ValueError("Expected one of {0!r} at {1!r}"
+                             .format(chars, self.buf[self.pos:self.pos + 20]))
+        self.pos += 1
+        return char
+
+    def _value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = _DECODER.raw_decode(self.buf, idx=self.pos)
+                # A value ending the buffer may be a truncated number
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+
+            self._fill()
+
+
+##### Multipart Encoding #####
+
+class MultipartEncoder(object):
+    """Streams a multipart/form-data body in fixed-size chunks.
+
+    File parts are read from disk (or from the given file object or
+    iterable) only while the body is being sent, so memory use does not
+    depend on the size of the files. `length` is the total body size, or
+    None if some part has an unknown size, in which case the body is
+    sent with chunked transfer encoding.
+    """
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, boundary=None, chunk_size=CHUNK_SIZE):
+        self.boundary = boundary or mimetools.choose_boundary()
+        self.chunk_size = chunk_size
+        self.parts = []
+
+    @property
+    def content_type(self):
+        return 'multipart/form-data; boundary={0}'.format(self.boundary)
+
+    @property
+    def length(self):
+        total = len(self._closing())
+        for headers, source, size, progress in self.parts:
+            if size is None:
+                return None
+            total += len(headers) + size + 2
+        return total
+
+    @property
+    def replayable(self):
+        for headers, source, size, progress in self.parts:
+            if isinstance(source, _FileSource):
+                if not source.seekable():
+                    return False
+            elif not isinstance(source, basestring):
+                return False
+        return True
+
+    def add_field(self, name, value,
+                  content_type='application/json; charset=UTF-8'):
+        headers = self._headers('form-data; name="{0}"'.format(name),
+                                content_type)
+        self.parts.append((headers, value, len(value), None))
+
+    def add_file(self, name, source, filename=None, content_type=None,
+                 size=None, progress=None):
+        """Adds a file part.
+
+        `source` may be a path, a file-like object, an iterable of
+        strings, or a tuple of (filename, source) or (filename, source,
+        size) where source is a file-like object or an iterable.
+        `progress(sent, size)` is called as each chunk of it is sent.
+        """
+        if isinstance(source, tuple):
+            filename, source, size = (source + (size,))[:3]
+
+        if isinstance(source, basestring):
+            filename = filename or os.path.basename(source)
+            size = os.path.getsize(source) if size is None else size
+            source = _FileSource(source)
+        elif hasattr(source, 'read'):
+            filename = filename or \
+                os.path.basename(getattr(source, 'name', None) or name)
+            source = _FileSource(source)
+            size = source.size() if size is None else size
+
+        if isinstance(filename, unicode):
+            filename = filename.encode('utf-8')
+
+        filename = filename or name
+        content_type = content_type or \
+            mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+        headers = self._headers(
+            'form-data; name="{0}"; filename="{1}"'.format(name, filename),
+            content_type)
+        self.parts.append((headers, source, size, progress))
+
+    def __iter__(self):
+        for headers, source, size, progress in self.parts:
+            yield headers
+
+            if isinstance(source, basestring):
+                yield source
+            else:
+                sent = 0
+                for chunk in self._read(source):
+                    sent += len(chunk)
+                    yield chunk
+                    if progress is not None:
+                        progress(sent, size)
+
+                if size is not None and sent != size:
+                    raise IOError("multipart part changed size while "
+                                  "sending: expected {0} bytes, got {1}"
+                                  .format(size, sent))
+            yield '\r\n'
+
+        yield self._closing()
+
+    def _read(self, source):
+        if isinstance(source, _FileSource):
+            return source.chunks(self.chunk_size)
+        return iter(source)
+
+    def _headers(self, disposition, content_type):
+        return '--{0}\r\nContent-Disposition: {1}\r\n' \
+            'Content-Type: {2}\r\n\r\n'.format(self.boundary, disposition,
+                                               content_type)
+
+    def _closing(self):
+        return '--{0}--\r\n'.format(self.boundary)
+
+
+class _FileSource(object):
+    """A file part read in binary mode from a path or a file object."""
+
+    def __init__(self, path_or_fileobj):
+        self.path = None
+        self.fileobj = None
+        self.offset = 0
+
+        if isinstance(path_or_fileobj, basestring):
+            self.path = path_or_fileobj
+        else:
+            self.fileobj = path_or_fileobj
+            try:
+                self.offset = path_or_fileobj.tell()
+            except (AttributeError, IOError):
+                self.offset = None
+
+    def seekable(self):
+        return self.path is not None or self.offset is not None
+
+    def size(self):
+        if self.path:
+            return os.path.getsize(self.path)
+
+        if self.offset is None:
+            return None
+
+        try:
+            st = os.fstat(self.fileobj.fileno())
+            if stat.S_ISREG(st.st_mode):
+                return st.st_size - self.offset
+        except (AttributeError, IOError, OSError):
+            pass
+
+        # Seekable objects without a file descriptor, e.g. StringIO
+        self.fileobj.seek(0, os.SEEK_END)
+        end = self.fileobj.tell()
+        self.fileobj.seek(self.offset)
+        return end - self.offset
+
+    def chunks(self, chunk_size):
+        if self.path:
+            fp = open(self.path, 'rb')
+        else:
+            fp = self.fileobj
+            if self.offset is not None:
+                fp.seek(self.offset)
+
+        try:
+            while True:
+                chunk = fp.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            if self.path:
+                fp.close()
+
+
+##### Connection Pool #####
+
+class ConnectionPool(object):
+    """Keeps persistent HTTP/1.1 connections to each host for reuse.
+
+    At most `maxsize` idle connections are kept per (scheme, host,
+    port). Idle connections older than `idle_timeout` seconds, or whose
+    socket the server has closed, are discarded instead of reused.
+    """
+
+    def __init__(self, maxsize=4, idle_timeout=30):
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+        self._stats = {'requests': 0,
+                       'connections_created': 0,
+                       'connections_reused': 0,
+                       'connections_discarded': 0}
+
+    def urlopen(self, method, url, body=None, headers=None, timeout=60,
+                record=None):
+        parts = urlparse.urlsplit(url)
+        key = (parts.scheme, parts.hostname,
+               parts.port or (443 if parts.scheme == 'https' else 80))
+        path = parts.path or '/'
+        if parts.query:
+            path = '{0}?{1}'.format(path, parts.query)
+
+        start = time.time()
+        conn, reused = self._get(key, timeout)
+        if record is not None:
+            record.timings['connect'] += time.time() - start
+            record.connection_reused = reused
+
+        try:
+            response = self._send(conn, method, path, body, headers or {},
+                                  record)
+        except (socket.error, httplib.HTTPException) as error:
+            conn.close()
+            self._count('connections_discarded')
+            if not reused or not self._is_stale(error) or \
+                    not (isinstance(body, basestring) or body is None or
+                         body.replayable):
+                raise
+            # The server may close a keep-alive connection at any time
+            # while it sits idle, before reading our request. Send it
+            # once more on a fresh connection.
+            start = time.time()
+            conn, reused = self._connect(key, timeout), False
+            if record is not None:
+                record.timings['connect'] += time.time() - start
+                record.connection_reused = False
+            response = self._send(conn, method, path, body, headers or {},
+                                  record)
+
+        self._count('requests')
+        return PooledResponse(self, key, conn, response, reused, record)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+
+        for conns in idle.values():
+            for conn, last_used in conns:
+                conn.close()
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['connections_idle'] = sum(len(c) for c in self._idle.values())
+        return stats
+
+    def _get(self, key, timeout):
+        while True:
+            with self._lock:
+                conns = self._idle.get(key)
+                if not conns:
+                    break
+                conn, last_used = conns.pop()
+
+            if self._is_usable(conn, last_used):
+                conn.timeout = timeout
+                conn.sock.settimeout(timeout)
+                self._count('connections_reused')
+                return conn, True
+
+            conn.close()
+            self._count('connections_discarded')
+
+        return self._connect(key, timeout), False
+
+    def _connect(self, key, timeout):
+        scheme, host, port = key
+        if scheme == 'https':
+            conn = httplib.HTTPSConnection(host, port, timeout=timeout)
+        else:
+            conn = httplib.HTTPConnection(host, port, timeout=timeout)
+
+        conn.connect()
+        # Headers and body go out in separate writes; don't let Nagle's
+        # algorithm hold the body back waiting for a delayed ACK.
+        conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        self._count('connections_created')
+        return conn
+
+    def _is_usable(self, conn, last_used):
+        if conn.sock is None:
+            return False
+
+        if time.time() - last_used > self.idle_timeout:
+            return False
+
+        # An idle connection should have nothing to read. If the socket
+        # is readable the server has closed it (or sent garbage).
+        try:
+            readable = select.select([conn.sock], [], [], 0)[0]
+        except (select.error, socket.error, ValueError):
+            return False
+
+        return not readable
+
+    def _send(self, conn, method, path, body, headers, record=None):
+        start = time.time()
+        sent = 0
+        conn.putrequest(method, path, skip_accept_encoding=True)
+
+        for name, value in headers.iteritems():
+            conn.putheader(name, value)
+
+        chunked = False
+        if isinstance(body, basestring):
+            conn.putheader('Content-Length', str(len(body)))
+        elif body is not None:
+            if body.length is None:
+                chunked = True
+                conn.putheader('Transfer-Encoding', 'chunked')
+            else:
+                conn.putheader('Content-Length', str(body.length))
+
+        conn.endheaders()
+
+        if isinstance(body, basestring):
+            conn.send(body)
+            sent = len(body)
+        elif chunked:
+            for chunk in body:
+                if chunk:
+                    conn.send('{0:x}\r\n{1}\r\n'.format(len(chunk), chunk))
+                    sent += len(chunk)
+            conn.send('0\r\n\r\n')
+        elif body is not None:
+            for chunk in body:
+                conn.send(chunk)
+                sent += len(chunk)
+
+        if record is None:
+            return conn.getresponse()
+
+        sent_at = time.time()
+        record.timings['send'] += sent_at - start
+        record.request_bytes += sent
+
+        response = conn.getresponse()
+        record.timings['wait'] += time.time() - sent_at
+        return response
+
+    def _is_stale(self, error):
+        """Whether `error` shows that a reused connection had already
+        been closed by the server, with nothing of a response read.
+        A timeout never does: the server may still be handling the
+        request.
+        """
+        if isinstance(error, socket.timeout):
+            return False
+        if isinstance(error, httplib.BadStatusLine):
+            line = error.line or ''
+            return line in ('', "''") or line.startswith('No status line')
+        return isinstance(error, socket.error) and error.errno in \
+            (errno.ECONNRESET, errno.EPIPE, errno.ECONNABORTED)
+
+    def _release(self, key, conn, response):
+        if not response.isclosed() or response.will_close or \
+                conn.sock is None:
+            conn.close()
+            self._count('connections_discarded')
+            return
+
+        with self._lock:
+            conns = self._idle.setdefault(key, [])
+            if len(conns) < self.maxsize:
+                conns.append((conn, time.time()))
+                return
+
+        conn.close()
+        self._count('connections_discarded')
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+
+class PooledResponse(object):
+    """A response whose connection goes back to its pool once read."""
+
+    def __init__(self, pool, key, conn, response, reused, record=None):
+        self.__pool = pool
+        self.__key = key
+        self.__conn = conn
+        self.__response = response
+        self.__record = record
+        self.reused = reused
+        self.status = response.status
+        self.reason = response.reason
+        self.msg = response.msg
+
+    def info(self):
+        return self.msg
+
+    def getheader(self, name, default=None):
+        return self.__response.getheader(name, default)
+
+    def read(self, amt=None):
+        start = time.time()
+        if amt is None:
+            data = self.__response.read()
+        else:
+            data = self.__response.read(amt)
+
+        if self.__record is not None:
+            self.__record.timings['read'] += time.time() - start
+            self.__record.response_bytes += len(data)
+
+        if amt is None or not data:
+            self.close()
+
+        return data
+
+    def close(self):
+        if self.__conn is None:
+            return
+
+        conn, self.__conn = self.__conn, None
+        self.__pool._release(self.__key, conn, self.__response)
+
+
+##### Local Mirror #####
+
+class SQLiteStore(object):
+    """A local SQLite mirror of flows, posts, comments and files.
+
+    Kept up to date with `Api.sync(store)`. Records are stored as the raw
+    JSON the server returned, and the query methods return the usual
+    model objects.
+    """
+    ENTITIES = ['flows', 'posts', 'comments']
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS flows (
+            id TEXT PRIMARY KEY, name TEXT, created_at REAL,
+            updated_at REAL, data TEXT);
+        CREATE TABLE IF NOT EXISTS posts (
+            id TEXT PRIMARY KEY, flow_id TEXT, user_id INTEGER,
+            created_at REAL, updated_at REAL, data TEXT);
+        CREATE INDEX IF NOT EXISTS posts_flow
+            ON posts (flow_id, created_at);
+        CREATE TABLE IF NOT EXISTS comments (
+            id TEXT PRIMARY KEY, post_id TEXT, flow_id TEXT,
+            user_id INTEGER, created_at REAL, updated_at REAL, data TEXT);
+        CREATE INDEX IF NOT EXISTS comments_post ON comments (post_id);
+        CREATE TABLE IF NOT EXISTS files (
+            id TEXT PRIMARY KEY, post_id TEXT, created_at REAL,
+            updated_at REAL, data TEXT);
+        CREATE INDEX IF NOT EXISTS files_post ON files (post_id);
+        CREATE TABLE IF NOT EXISTS sync_state (
+            entity TEXT PRIMARY KEY, high_water TEXT);
+        """
+
+    def __init__(self, path, api=None):
+        self.path = path
+        self.api = api
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SQLiteStore.SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def get_high_water(self, entity):
+        row = self.db.execute(
+            'SELECT high_water FROM sync_state WHERE entity = ?',
+            (entity,)).fetchone()
+        return row[0] if row else None
+
+    def set_high_water(self, entity, high_water):
+        if high_water is None:
+            return
+        with self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO sync_state VALUES (?, ?)',
+                (entity, high_water))
+
+    def apply(self, entity, data, high_water=None):
+        """Stores one response page and returns the new high-water mark."""
+        with self.db:
+            for record in data.get(entity) or []:
+                updated_at = record.get('updated_at')
+                if updated_at and (high_water is None or
+                                   _timestamp_key(updated_at) >
+                                   _timestamp_key(high_water)):
+                    high_water = updated_at
+
+                if record.get('_removed'):
+                    self._remove(entity, record['id'])
+                elif entity == 'flows':
+                    self._put_flow(record, data)
+                else:
+                    self._put(entity, record)
+
+            if entity == 'posts':
+                for record in data.get('files') or []:
+                    self._put('files', record)
+                for record in data.get('comments') or []:
+                    self._put('comments', record)
+
+        return high_water
+
+    def get_flows(self, name=None):
+        sql = 'SELECT data FROM flows'
+        args = ()
+        if name:
+            sql += ' WHERE name = ?'
+            args = (name,)
+
+        data = {'flows': [], 'memberships': [], 'invitations': []}
+        for (row,) in self.db.execute(sql + ' ORDER BY created_at DESC',
+                                      args):
+            flow = CODEC.loads(row)
+            data['memberships'].extend(flow.pop('memberships', []))
+            data['invitations'].extend(flow.pop('invitations', []))
+            data['flows'].append(flow)
+
+        return self.api._merge_flow_data(data)
+
+    def get_post(self, post_id):
+        posts = self._select_posts('WHERE id = ?', (post_id,))
+        return posts[0] if posts else None
+
+    def get_posts(self, flow_id=None, limit=None, order_by='created',
+                  before=None, after=None):
+        if order_by not in ['updated', 'created']:
+            raise ValueError("order_by must be one of 'updated', 'created'")
+
+        clauses = []
+        args = []
+
+        if flow_id:
+            flow_ids = [flow_id] if isinstance(flow_id, basestring) \
+                else list(flow_id)
+            clauses.append('flow_id IN ({0})'.format(
+                    ', '.join('?' * len(flow_ids))))
+            args.extend(flow_ids)
+
+        if before:
+            clauses.append('{0}_at < ?'.format(order_by))
+            args.append(_timestamp_key(before))
+
+        if after:
+            clauses.append('{0}_at > ?'.format(order_by))
+            args.append(_timestamp_key(after))
+
+        sql = 'WHERE ' + ' AND '.join(clauses) if clauses else ''
+        sql += ' ORDER BY {0}_at DESC'.format(order_by)
+        if limit:
+            sql += ' LIMIT {0:d}'.format(limit)
+
+        return self._select_posts(sql, args)
+
+    def get_comments(self, post_id):
+        rows = self.db.execute(
+            'SELECT data FROM comments WHERE post_id = ? '
+            'ORDER BY created_at', (post_id,))
+        return [self.api._load(Comment, CODEC.loads(row)) for (row,) in rows]
+
+    def get_files(self, post_id):
+        rows = self.db.execute(
+            'SELECT data FROM files WHERE post_id = ? ORDER BY created_at',
+            (post_id,))
+        return [self.api._load(File, self.api.requester, CODEC.loads(row))
+                for (row,) in rows]
+
+    def export_columns(self, flow_id=None):
+        """Reads the mirror into `ColumnTable`s keyed 'posts', 'files'
+        and 'comments', like `Api.export_columns`.
+
+        Posts and comments come straight from the indexed columns; only
+        file sizes, dimensions and content types are read from the
+        stored JSON. Requires NumPy.
+        """
+        writers = _column_writers(['posts', 'files', 'comments'])
+
+        where = lambda table: ''
+        args = []
+        if flow_id:
+            flow_ids = [flow_id] if isinstance(flow_id, basestring) \
+                else list(flow_id)
+            where = lambda table: ' WHERE {0}.flow_id IN ({1})'.format(
+                table, ', '.join('?' * len(flow_ids)))
+            args = flow_ids
+
+        append = writers['posts'].append
+        for row in self.db.execute(
+                'SELECT id, flow_id, user_id, created_at, updated_at '
+                'FROM posts' + where('posts'), args):
+            append(row)
+
+        append = writers['comments'].append
+        for row in self.db.execute(
+                'SELECT id, post_id, flow_id, user_id, created_at, '
+                'updated_at FROM comments' + where('comments'), args):
+            append(row)
+
+        append = writers['files'].append
+        for (id, post_id, flow, user, created_at, updated_at,
+             data) in self.db.execute(
+                'SELECT files.id, files.post_id, posts.flow_id, '
+                'posts.user_id, files.created_at, files.updated_at, '
+                'files.data FROM files LEFT JOIN posts '
+                'ON posts.id = files.post_id' + where('posts'), args):
+            record = CODEC.loads(data)
+            append((id, post_id, flow, user, record.get('content_type'),
+                    record.get('file_size'), record.get('width'),
+                    record.get('height'), created_at, updated_at))
+
+        return _column_tables(writers)
+
+    def _select_posts(self, where, args):
+        data = {'posts': [], 'files': [], 'comments': []}
+
+        for (row,) in self.db.execute('SELECT data FROM posts ' + where,
+                                      args):
+            data['posts'].append(CODEC.loads(row))
+
+        ids = [post['id'] for post in data['posts']]
+        # Stay under SQLite's limit of 999 bound parameters
+        for i in xrange(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            marks = ', '.join('?' * len(chunk))
+            for table in ('files', 'comments'):
+                rows = self.db.execute(
+                    'SELECT data FROM {0} WHERE post_id IN ({1})'
+                    .format(table, marks), chunk)
+                data[table].extend(CODEC.loads(row) for (row,) in rows)
+
+        return self.api._merge_post_data(data)
+
+    def _put(self, entity, record):
+        created_at = _timestamp_key(record.get('created_at'))
+        updated_at = _timestamp_key(record.get('updated_at'))
+        data = CODEC.dumps(record)
+
+        if entity == 'posts':
+            self.db.execute(
+                'INSERT OR REPLACE INTO posts VALUES (?, ?, ?, ?, ?, ?)',
+                (record['id'], record.get('flow_id'), record.get('user_id'),
+                 created_at, updated_at, data))
+        elif entity == 'comments':
+            self.db.execute(
+                'INSERT OR REPLACE INTO comments VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (record['id'], record.get('reply_to'), record.get('flow_id'),
+                 record.get('user_id'), created_at, updated_at, data))
+        elif entity == 'files':
+            self.db.execute(
+                'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)',
+                (record['id'], record.get('post_id'), created_at, updated_at,
+                 data))
+
+    def _put_flow(self, record, data):
+        record = dict(record)
+        record['memberships'] = [m for m in data.get('memberships') or []
+                                 if m.get('channel_id') == record['id']]
+        record['invitations'] = [i for i in data.get('invitations') or []
+                                 if i.get('channel_id') == record['id']]
+
+        self.db.execute(
+            'INSERT OR REPLACE INTO flows VALUES (?, ?, ?, ?, ?)',
+            (record['id'], record.get('name'),
+             _timestamp_key(record.get('created_at')),
+             _timestamp_key(record.get('updated_at')), CODEC.dumps(record)))
+
+    def _remove(self, entity, id):
+        if entity == 'flows':
+            posts = [row[0] for row in self.db.execute(
+                    'SELECT id FROM posts WHERE flow_id = ?', (id,))]
+            for post_id in posts:
+                self._remove('posts', post_id)
+        elif entity == 'posts':
+            self.db.execute('DELETE FROM files WHERE post_id = ?', (id,))
+            self.db.execute('DELETE FROM comments WHERE post_id = ?', (id,))
+
+        self.db.execute('DELETE FROM {0} WHERE id = ?'.format(entity), (id,))
+
+
+def _timestamp_key(value):
+    """Returns a timestamp as seconds since the epoch, for sorting."""
+    if value is None:
+        return None
+    if isinstance(value, basestring):
+        value = parse_timestamp(value)
+    if isinstance(value, datetime):
+        return calendar.timegm(value.utctimetuple()) + \
+            value.microsecond / 1e6
+    return value
+
+
+##### Local Search #####
+
+_TOKEN_RE = re.compile(r'\w\w+', re.UNICODE)
+_TAG_RE = re.compile(r'<[^>]*>')
+
+def _tokenize(text):
+    if not text or not isinstance(text, basestring):
+        return []
+    if isinstance(text, str):
+        text = text.decode('utf-8', 'replace')
+    return _TOKEN_RE.findall(_TAG_RE.sub(' ', text).lower())
+
+
+class TextIndex(object):
+    """An in-memory full-text index of posts.
+
+    A post is indexed by its content, the content of its comments, the
+    names of its files and, for email posts, the subject. Adding a post
+    again replaces its entry. Results are ranked with BM25.
+
+    The posts are held by weak reference in `posts`, so results can be
+    returned without asking the server while you still use them. They
+    are not saved by `save`.
+    """
+    K1 = 1.2
+    B = 0.75
+    FORMAT = 1
+
+    def __init__(self):
+        self.posts = weakref.WeakValueDictionary()
+        # term -> {post id: term count}
+        self._postings = {}
+        # post id -> (terms, length, flow id, created_at, updated_at)
+        self._docs = {}
+        self._total_length = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._docs)
+
+    def __contains__(self, post_id):
+        return post_id in self._docs
+
+    def add(self, post):
+        counts = {}
+        for text in self._texts(post):
+            for term in _tokenize(text):
+                counts[term] = counts.get(term, 0) + 1
+
+        with self._lock:
+            self._remove(post.id)
+            self._insert(post.id, counts, post.flow_id,
+                         _timestamp_key(post.created_at),
+                         _timestamp_key(post.updated_at))
+            self.posts[post.id] = post
+
+    def add_posts(self, posts):
+        for post in posts:
+            self.add(post)
+
+    def remove(self, post_id):
+        with self._lock:
+            self._remove(post_id)
+
+    def search(self, query, limit=30, flow_id=None, order_by='created',
+               before=None, after=None):
+        """Returns up to `limit` (post id, score) pairs for the posts
+        matching every word of `query`, best first.
+
+        `before` and `after` filter on `created_at`, or `updated_at`
+        with `order_by='updated'`. `flow_id` may be an id or a list.
+        """
+        terms = set(_tokenize(query))
+        if not terms:
+            return []
+
+        if flow_id is not None and isinstance(flow_id, basestring):
+            flow_id = [flow_id]
+        flows = set(flow_id) if flow_id is not None else None
+        time_index = 4 if order_by == 'updated' else 3
+        before = _timestamp_key(before)
+        after = _timestamp_key(after)
+
+        with self._lock:
+            postings = [self._postings.get(term) for term in terms]
+            if not all(postings):
+                return []
+
+            # Intersect starting from the rarest term
+            postings.sort(key=len)
+            count = float(len(self._docs))
+            average = self._total_length / count
+            scores = {}
+            for post_id in postings[0]:
+                doc = self._docs[post_id]
+                if flows is not None and doc[2] not in flows:
+                    continue
+                stamp = doc[time_index]
+                if before is not None and (stamp is None or stamp >= before):
+                    continue
+                if after is not None and (stamp is None or stamp <= after):
+                    continue
+
+                score = 0.0
+                for posting in postings:
+                    tf = posting.get(post_id)
+                    if tf is None:
+                        break
+                    idf = math.log(1 + (count - len(posting) + 0.5) /
+                                   (len(posting) + 0.5))
+                    norm = 1 - self.B + self.B * doc[1] / average
+                    score += idf * tf * (self.K1 + 1) / (tf + self.K1 * norm)
+                else:
+                    scores[post_id] = score
+
+        return heapq.nlargest(limit, scores.iteritems(),
+                              key=lambda item: item[1])
+
+    def save(self, path):
+        """Writes the index to `path` as compressed JSON, atomically.
+
+        Posts are numbered, and each postings list is stored as
+        increasing post numbers, delta encoded, followed by the counts.
+        """
+        with self._lock:
+            ids = sorted(self._docs)
+            numbers = dict((id, n) for n, id in enumerate(ids))
+            docs = [[id] + list(self._docs[id][1:]) for id in ids]
+
+            terms = {}
+            for term, posting in self._postings.iteritems():
+                ordered = sorted((numbers[id], tf)
+                                 for id, tf in posting.iteritems())
+                deltas, previous = [], 0
+                for number, tf in ordered:
+                    deltas.append(number - previous)
+                    previous = number
+                terms[term] = deltas + [tf for number, tf in ordered]
+
+        data = zlib.compress(json.dumps(
+            {'format': TextIndex.FORMAT, 'docs': docs, 'terms': terms},
+            separators=(',', ':')), 9)
+
+        temp = '{0}.tmp-{1}'.format(path, os.getpid())
+        with open(temp, 'wb') as fp:
+            fp.write(data)
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(temp, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as fp:
+            data = json.loads(zlib.decompress(fp.read()))
+        if data.get('format') != TextIndex.FORMAT:
+            raise ValueError("unknown text index format in {0}".format(path))
+
+        index = cls()
+        ids = [doc[0] for doc in data['docs']]
+        counts = dict((id, {}) for id in ids)
+        for term, values in data['terms'].iteritems():
+            half = len(values) // 2
+            number = 0
+            for delta, tf in zip(values[:half], values[half:]):
+                number += delta
+                counts[ids[number]][term] = tf
+
+        for id, length, flow_id, created_at, updated_at in data['docs']:
+            index._insert(id, counts[id], flow_id, created_at, updated_at)
+        return index
+
+    def _texts(self, post):
+        if post.is_map():
+            # Map posts decode their content into a dict
+            yield (post.content or {}).get('address')
+        else:
+            yield post.content
+        for comment in post.comments:
+            yield comment.content
+        for file in post.files:
+            yield re.sub(r'[\W_]+', ' ', file.file_name or '')
+        if post.is_email() and post.msg is not None:
+            yield (post.msg.meta_data or {}).get('subject')
+
+    def _insert(self, post_id, counts, flow_id, created_at, updated_at):
+        length = sum(counts.itervalues())
+        self._docs[post_id] = (tuple(counts), length, flow_id, created_at,
+                               updated_at)
+        self._total_length += length
+        for term, tf in counts.iteritems():
+            self._postings.setdefault(term, {})[post_id] = tf
+
+    def _remove(self, post_id):
+        self.posts.pop(post_id, None)
+        doc = self._docs.pop(post_id, None)
+        if doc is None:
+            return
+
+        self._total_length -= doc[1]
+        for term in doc[0]:
+            posting = self._postings[term]
+            del posting[post_id]
+            if not posting:
+                del self._postings[term]
+
+
+##### Columnar Export #####
+
+# NaT, as the int64 behind a datetime64
+_NAT = -1 << 63
+
+# Per entity: (column, record field, kind, dictionary or missing value)
+_EXPORT_COLUMNS = {
+    'posts': [
+        ('id', 'id', 'code', 'posts'),
+        ('flow_id', 'flow_id', 'code', 'flows'),
+        ('user_id', 'user_id', 'code', 'users'),
+        ('created_at', 'created_at', 'time', None),
+        ('updated_at', 'updated_at', 'time', None)],
+    'comments': [
+        ('id', 'id', 'code', 'comments'),
+        ('post_id', 'reply_to', 'code', 'posts'),
+        ('flow_id', 'flow_id', 'code', 'flows'),
+        ('user_id', 'user_id', 'code', 'users'),
+        ('created_at', 'created_at', 'time', None),
+        ('updated_at', 'updated_at', 'time', None)],
+    'files': [
+        ('id', 'id', 'code', 'files'),
+        ('post_id', 'post_id', 'code', 'posts'),
+        ('flow_id', 'flow_id', 'code', 'flows'),
+        ('user_id', 'user_id', 'code', 'users'),
+        ('content_type', 'content_type', 'code', 'content_types'),
+        ('file_size', 'file_size', 'int64', 0),
+        ('width', 'width', 'int32', -1),
+        ('height', 'height', 'int32', -1),
+        ('created_at', 'created_at', 'time', None),
+        ('updated_at', 'updated_at', 'time', None)],
+    }
+
+
+class CodeDictionary(object):
+    """Assigns integer codes to values, in the order they are first
+    seen. `None` is always -1.
+    """
+    def __init__(self):
+        self.values = []
+        self._codes = {}
+
+    def __len__(self):
+        return len(self.values)
+
+    def encode(self, value):
+        if value is None:
+            return -1
+        code = self._codes.get(value)
+        if code is None:
+            code = self._codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def code(self, value):
+        """Returns the code of `value`, or -1 if it was never seen."""
+        return self._codes.get(value, -1)
+
+    def decode(self, codes):
+        """Returns the values of an array of codes, as an object array."""
+        values = numpy.empty(len(self.values) + 1, dtype=object)
+        values[:-1] = self.values
+        values[-1] = None
+        return values[codes]
+
+
+class ColumnTable(object):
+    """Records stored as one NumPy array per column.
+
+    Columns listed in `dictionaries` hold int32 codes from a
+    `CodeDictionary`, with -1 for missing values. The tables of one
+    export share their dictionaries, so a post has the same code in
+    `posts['id']`, `files['post_id']` and `comments['post_id']`.
+    Timestamps are `datetime64[us]`, with NaT for missing values.
+    """
+    def __init__(self, columns, dictionaries=None):
+        self.columns = columns
+        self.dictionaries = dictionaries or {}
+
+    def __len__(self):
+        for column in self.columns.itervalues():
+            return len(column)
+        return 0
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def code(self, name, value):
+        """Returns the code of `value` in column `name`, for filters."""
+        return self.dictionaries[name].code(value)
+
+    def decode(self, name):
+        return self.dictionaries[name].decode(self.columns[name])
+
+    def filter(self, mask):
+        """Returns the rows where the boolean array `mask` is true."""
+        return ColumnTable(dict((name, column[mask]) for name, column
+                                in self.columns.iteritems()),
+                           self.dictionaries)
+
+    def count_by(self, *names):
+        """Counts the rows for each distinct combination of the named
+        columns. Returns a table of those columns and `count`, sorted
+        by them.
+        """
+        order, starts = self._groups(names)
+        columns = self._group_columns(names, order, starts)
+        columns['count'] = numpy.diff(numpy.append(starts, len(order)))
+        return ColumnTable(columns, self._dictionaries(names))
+
+    def sum_by(self, names, column):
+        """Sums `column` for each distinct combination of the columns in
+        `names`. Returns a table of those columns, the sums as `column`
+        and `count`, sorted by the named columns.
+        """
+        order, starts = self._groups(names)
+        columns = self._group_columns(names, order, starts)
+        values = self.columns[column][order]
+        if len(values):
+            columns[column] = numpy.add.reduceat(values, starts)
         else:
-            fp = response
+            columns[column] = values
+        columns['count'] = numpy.diff(numpy.append(starts, len(order)))
+        return ColumnTable(columns, self._dictionaries(names))
+
+    def _groups(self, names):
+        """Returns the order that sorts the rows by the named columns,
+        and the positions in it where each group starts.
+        """
+        keys = [_sort_key(self.columns[name]) for name in names]
+        # lexsort sorts by its last key first
+        order = numpy.lexsort(keys[::-1])
+        starts = numpy.zeros(len(order), dtype=bool)
+        starts[:1] = True
+        for key in keys:
+            key = key[order]
+            starts[1:] |= key[1:] != key[:-1]
+        return order, numpy.flatnonzero(starts)
+
+    def _group_columns(self, names, order, starts):
+        first = order[starts]
+        return dict((name, self.columns[name][first]) for name in names)
+
+    def _dictionaries(self, names):
+        return dict((name, self.dictionaries[name]) for name in names
+                    if name in self.dictionaries)
+
+
+def posts_per_flow_per_day(posts):
+    """Counts posts per flow per UTC day of `created_at`. Returns a
+    `ColumnTable` of `flow_id`, `day` (datetime64[D]) and `count`.
+    """
+    days = posts['created_at'].astype('datetime64[D]')
+    table = ColumnTable({'flow_id': posts['flow_id'], 'day': days},
+                        posts.dictionaries)
+    table = table.filter((posts['flow_id'] >= 0) &
+                         (days.view('int64') != _NAT))
+    return table.count_by('flow_id', 'day')
+
+
+def bytes_per_user(files):
+    """Totals file sizes per user who posted them. Returns a
+    `ColumnTable` of `user_id`, `file_size` and `count`.
+    """
+    files = files.filter(files['user_id'] >= 0)
+    return files.sum_by(['user_id'], 'file_size')
+
+
+class _ColumnWriter(object):
+    """Appends rows to typed `array` buffers, which are turned into
+    NumPy arrays at the end without a Python object per value.
+    """
+    # kind -> (array typecode, dtype of the buffer)
+    TYPES = {'code': ('i', 'int32'),
+             'int32': ('i', 'int32'),
+             'int64': ('d', 'float64'),
+             'time': ('d', 'float64')}
+
+    def __init__(self, entity, dictionaries):
+        self.columns = _EXPORT_COLUMNS[entity]
+        self.dictionaries = dictionaries
+        self._buffers = []
+        self._encoders = []
+
+        for name, field, kind, arg in self.columns:
+            self._buffers.append(array.array(self.TYPES[kind][0]))
+            if kind == 'code':
+                if arg not in dictionaries:
+                    dictionaries[arg] = CodeDictionary()
+                self._encoders.append(dictionaries[arg].encode)
+            elif kind == 'time':
+                self._encoders.append(_export_seconds)
+            else:
+                self._encoders.append(
+                    lambda value, missing=arg:
+                        int(value) if value else missing)
+
+    def append(self, values):
+        """Appends one row, given as values in column order."""
+        for buffer, encode, value in zip(self._buffers, self._encoders,
+                                         values):
+            buffer.append(encode(value))
+
+    def append_record(self, record):
+        self.append([record.get(field) for name, field, kind, arg
+                     in self.columns])
+
+    def table(self):
+        columns = {}
+        dictionaries = {}
+        for (name, field, kind, arg), buffer in zip(self.columns,
+                                                    self._buffers):
+            dtype = self.TYPES[kind][1]
+            if len(buffer):
+                values = numpy.frombuffer(buffer, dtype=dtype).copy()
+            else:
+                values = numpy.zeros(0, dtype=dtype)
+
+            if kind == 'code':
+                dictionaries[name] = self.dictionaries[arg]
+            elif kind == 'time':
+                values = _datetime64(values)
+            elif kind == 'int64':
+                values = values.astype('int64')
+            columns[name] = values
+        return ColumnTable(columns, dictionaries)
+
+
+def _column_writers(entities):
+    """Returns a `_ColumnWriter` per entity, sharing dictionaries."""
+    if numpy is None:
+        raise ImportError("exporting columns requires NumPy")
+    dictionaries = {}
+    return dict((entity, _ColumnWriter(entity, dictionaries))
+                for entity in entities)
+
+
+def _column_tables(writers):
+    return dict((entity, writer.table())
+                for entity, writer in writers.iteritems())
+
+
+def _fill_file_owners(files, posts):
+    """Fills in the flow and user of files from their posts, which the
+    server does not include in file records.
+    """
+    size = len(posts.dictionaries['id']) + 1
+    for name in ('flow_id', 'user_id'):
+        # The extra last slot maps missing post codes (-1) to -1
+        lookup = numpy.empty(size, dtype='int32')
+        lookup.fill(-1)
+        lookup[posts['id']] = posts[name]
+        column = files[name]
+        files.columns[name] = numpy.where(column >= 0, column,
+                                          lookup[files['post_id']])
+
+
+def _export_seconds(value):
+    if value is None or value == '':
+        return float('nan')
+    return _timestamp_key(value)
+
+
+def _datetime64(seconds):
+    """Converts float seconds since the epoch, NaN for missing, to
+    datetime64[us].
+    """
+    missing = numpy.isnan(seconds)
+    micros = numpy.round(numpy.where(missing, 0, seconds) * 1e6)
+    micros = micros.astype('int64')
+    micros[missing] = _NAT
+    return micros.view('datetime64[us]')
+
+
+def _sort_key(column):
+    if column.dtype.kind == 'M':
+        return column.view('int64')
+    return column
+
+
+##### Scheduling #####
+
+class Scheduler(object):
+    """Paces the requests of every requester that shares it.
+
+    Combines three controls:
+
+    * A token bucket allowing `rate` requests per second on average,
+      with bursts of up to `burst`. `rate=None` disables it.
+    * An adaptive limit on concurrent requests. It grows by about one
+      for each window of successful requests, and shrinks by
+      `backoff_factor` when a request fails from overload or the average
+      latency exceeds `latency_tolerance` times the lowest latency seen.
+    * Retries of failed idempotent requests, up to `max_retries`, after
+      a jittered exponential backoff.
+    """
+    RETRY_STATUSES = set([httplib.INTERNAL_SERVER_ERROR, httplib.BAD_GATEWAY,
+                          httplib.SERVICE_UNAVAILABLE,
+                          httplib.GATEWAY_TIMEOUT, 429])
+
+    def __init__(self, rate=None, burst=10, concurrency=4,
+                 min_concurrency=1, max_concurrency=64, latency_tolerance=2.0,
+                 backoff_factor=0.7, max_retries=3, retry_base=0.5,
+                 retry_cap=30.0):
+        self.rate = rate
+        self.burst = burst
+        self.limit = float(concurrency)
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.latency_tolerance = latency_tolerance
+        self.backoff_factor = backoff_factor
+        self.max_retries = max_retries
+        self.retry_base = retry_base
+        self.retry_cap = retry_cap
+
+        self.in_flight = 0
+        self.latency = None
+        self.min_latency = None
+        self.retries = 0
+        self.failures = 0
+        self.requests = 0
+
+        self._tokens = float(burst)
+        self._refilled = time.time()
+        self._window = 0
+        self._cond = threading.Condition()
+
+    def call(self, fn, retryable=False):
+        """Runs `fn` once capacity is available, retrying it on
+        transient errors if `retryable` is true.
+        """
+        attempt = 0
+        while True:
+            self._acquire()
+            start = time.time()
+            try:
+                result = fn()
+            except Exception as error:
+                transient = self._is_transient(error)
+                self._release(time.time() - start, overloaded=transient)
+
+                if not (retryable and transient and
+                        attempt < self.max_retries):
+                    raise
+
+                attempt += 1
+                with self._cond:
+                    self.retries += 1
+                time.sleep(random.uniform(
+                        0, min(self.retry_cap,
+                               self.retry_base * 2 ** attempt)))
+                continue
+
+            self._release(time.time() - start)
+            return result
+
+    def get_stats(self):
+        with self._cond:
+            return {'concurrency_limit': int(self.limit),
+                    'in_flight': self.in_flight,
+                    'requests': self.requests,
+                    'failures': self.failures,
+                    'retries': self.retries,
+                    'latency': self.latency,
+                    'min_latency': self.min_latency}
+
+    def _acquire(self):
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+
+        if self.rate is None:
+            return
+
+        while True:
+            with self._cond:
+                now = time.time()
+                self._tokens = min(self.burst, self._tokens +
+                                   (now - self._refilled) * self.rate)
+                self._refilled = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def _release(self, latency, overloaded=False):
+        with self._cond:
+            self.in_flight -= 1
+            self.requests += 1
+            self._window += 1
+
+            if overloaded:
+                self.failures += 1
+                self._decrease()
+            else:
+                if self.min_latency is None or latency < self.min_latency:
+                    self.min_latency = latency
+                if self.latency is None:
+                    self.latency = latency
+                self.latency = 0.9 * self.latency + 0.1 * latency
+
+                if self.latency > self.min_latency * self.latency_tolerance:
+                    self._decrease()
+                else:
+                    self.limit = min(self.max_concurrency,
+                                     self.limit + 1.0 / self.limit)
+
+            self._cond.notify_all()
+
+    def _decrease(self):
+        # Requests already in flight when the limit dropped report the
+        # same overload; shrink at most once per window of requests.
+        if self._window < self.limit:
+            return
+        self._window = 0
+        self.limit = max(self.min_concurrency,
+                         self.limit * self.backoff_factor)
+
+    @staticmethod
+    def _is_transient(error):
+        if isinstance(error, ServiceError):
+            return True
+        if isinstance(error, urllib2.HTTPError):
+            return error.code in Scheduler.RETRY_STATUSES
+        return isinstance(error, (socket.error, httplib.HTTPException))
+
+
+##### Instrumentation #####
+
+class RequestRecord(object):
+    """Describes one call to the Shareflow API, as passed to request hooks.
+
+    `timings` holds the seconds spent in each of `PHASES`, summed over
+    all attempts. `response_bytes` counts bytes as they came off the
+    wire and `decoded_bytes` after decompression. For streamed
+    responses, the record covers the request up to the response headers.
+    """
+    __slots__ = ['kind', 'entity', 'method', 'status', 'request_bytes',
+                 'response_bytes', 'decoded_bytes', 'attempts', 'error',
+                 'total', 'timings', 'connection_reused']
+
+    PHASES = ['connect', 'send', 'wait', 'read', 'decode']
+
+    def __init__(self, kind, entity=None, method=None):
+        self.kind = kind
+        self.entity = entity
+        self.method = method
+        self.status = None
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.decoded_bytes = 0
+        self.attempts = 0
+        self.error = None
+        self.total = 0.0
+        self.timings = dict((phase, 0.0) for phase in RequestRecord.PHASES)
+        self.connection_reused = None
+
+    @property
+    def retries(self):
+        return max(0, self.attempts - 1)
+
+    @property
+    def gzip_ratio(self):
+        """Decoded bytes per wire byte, or None if nothing was read."""
+        if not self.response_bytes or not self.decoded_bytes:
+            return None
+        return float(self.decoded_bytes) / self.response_bytes
+
+    def to_dict(self):
+        return {'kind': self.kind, 'entity': self.entity,
+                'method': self.method, 'status': self.status,
+                'request_bytes': self.request_bytes,
+                'response_bytes': self.response_bytes,
+                'decoded_bytes': self.decoded_bytes,
+                'attempts': self.attempts, 'retries': self.retries,
+                'error': self.error and repr(self.error),
+                'total': self.total, 'timings': dict(self.timings),
+                'connection_reused': self.connection_reused}
+
+
+class Histogram(object):
+    """Counts observations into fixed, cumulative buckets."""
+    __slots__ = ['buckets', 'counts', 'count', 'sum']
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                       2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+    def quantile(self, q):
+        """Estimates the `q` quantile as the upper bound of its bucket."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        for bound, count in zip(self.buckets, self.counts):
+            if count >= rank:
+                return bound
+        return float('inf')
+
+    def to_dict(self):
+        return {'buckets': list(self.buckets), 'counts': list(self.counts),
+                'count': self.count, 'sum': self.sum}
+
+
+class MetricsRegistry(object):
+    """A request hook that aggregates `RequestRecord`s.
+
+    Latencies are kept as histograms per (kind, entity, method) and per
+    phase. Counters track bytes sent and received, responses by status,
+    retries and errors. Export them with `prometheus()` or `snapshot()`.
+    """
+
+    def __init__(self, buckets=Histogram.DEFAULT_BUCKETS, prefix='shareflow'):
+        self.buckets = buckets
+        self.prefix = prefix
+        self.clear()
+
+    def __call__(self, record):
+        labels = (record.kind, record.entity or '', record.method or '')
+        with self._lock:
+            self._histogram(self.latency, labels).observe(record.total)
+            for phase, seconds in record.timings.iteritems():
+                if seconds:
+                    self._histogram(self.phases, labels + (phase,)).observe(
+                        seconds)
+
+            self._add(self.requests, labels, 1)
+            self._add(self.bytes_sent, labels, record.request_bytes)
+            self._add(self.bytes_received, labels, record.response_bytes)
+            self._add(self.bytes_decoded, labels, record.decoded_bytes)
+            self._add(self.retries, labels, record.retries)
+            self._add(self.statuses, labels + (str(record.status or 0),), 1)
+            if record.error is not None:
+                self._add(self.errors,
+                          labels + (record.error.__class__.__name__,), 1)
+
+    def clear(self):
+        self._lock = threading.Lock()
+        self.latency = {}
+        self.phases = {}
+        self.requests = {}
+        self.bytes_sent = {}
+        self.bytes_received = {}
+        self.bytes_decoded = {}
+        self.retries = {}
+        self.statuses = {}
+        self.errors = {}
+
+    def snapshot(self):
+        """Returns the metrics as a JSON-serializable dict."""
+        def rows(metric, names, value=lambda v: v):
+            return [dict(zip(names, key), value=value(metric[key]))
+                    for key in sorted(metric)]
+
+        labels = ['kind', 'entity', 'method']
+        with self._lock:
+            return {
+                'latency': rows(self.latency, labels,
+                                lambda h: h.to_dict()),
+                'phases': rows(self.phases, labels + ['phase'],
+                               lambda h: h.to_dict()),
+                'requests': rows(self.requests, labels),
+                'bytes_sent': rows(self.bytes_sent, labels),
+                'bytes_received': rows(self.bytes_received, labels),
+                'bytes_decoded': rows(self.bytes_decoded, labels),
+                'retries': rows(self.retries, labels),
+                'statuses': rows(self.statuses, labels + ['status']),
+                'errors': rows(self.errors, labels + ['error']),
+            }
+
+    def prometheus(self):
+        """Returns the metrics in the Prometheus text exposition format."""
+        labels = ['kind', 'entity', 'method']
+        lines = []
+        with self._lock:
+            self._histogram_lines(lines, 'request_seconds',
+                                  'Time spent in API requests.',
+                                  self.latency, labels)
+            self._histogram_lines(lines, 'request_phase_seconds',
+                                  'Time spent in each phase of API requests.',
+                                  self.phases, labels + ['phase'])
+            for name, help, metric, names in [
+                    ('requests_total', 'API requests made.',
+                     self.requests, labels),
+                    ('request_bytes_total', 'Request bytes sent.',
+                     self.bytes_sent, labels),
+                    ('response_bytes_total', 'Response bytes received.',
+                     self.bytes_received, labels),
+                    ('response_decoded_bytes_total',
+                     'Response bytes after decompression.',
+                     self.bytes_decoded, labels),
+                    ('retries_total', 'Requests retried.',
+                     self.retries, labels),
+                    ('responses_total', 'Responses by HTTP status.',
+                     self.statuses, labels + ['status']),
+                    ('errors_total', 'Requests that failed.',
+                     self.errors, labels + ['error'])]:
+                name = '{0}_{1}'.format(self.prefix, name)
+                lines.append('# HELP {0} {1}'.format(name, help))
+                lines.append('# TYPE {0} counter'.format(name))
+                for key in sorted(metric):
+                    lines.append('{0}{{{1}}} {2}'.format(
+                        name, self._labels(names, key), metric[key]))
+        return '\n'.join(lines) + '\n'
+
+    def _histogram(self, metric, key):
+        if key not in metric:
+            metric[key] = Histogram(self.buckets)
+        return metric[key]
+
+    def _add(self, metric, key, value):
+        metric[key] = metric.get(key, 0) + value
+
+    def _histogram_lines(self, lines, name, help, metric, names):
+        name = '{0}_{1}'.format(self.prefix, name)
+        lines.append('# HELP {0} {1}'.format(name, help))
+        lines.append('# TYPE {0} histogram'.format(name))
+        for key in sorted(metric):
+            histogram = metric[key]
+            labels = self._labels(names, key)
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                lines.append('{0}_bucket{{{1},le="{2}"}} {3}'.format(
+                    name, labels, bound, count))
+            lines.append('{0}_bucket{{{1},le="+Inf"}} {2}'.format(
+                name, labels, histogram.count))
+            lines.append('{0}_sum{{{1}}} {2}'.format(name, labels,
+                                                     histogram.sum))
+            lines.append('{0}_count{{{1}}} {2}'.format(name, labels,
+                                                       histogram.count))
+
+    def _labels(self, names, values):
+        return ','.join('{0}="{1}"'.format(name, value.replace('"', '\\"'))
+                        for name, value in zip(names, values))
+
+
+# Per thread, the outermost public Api or Batch method running and the
+# timeout set with `Requester.timeout`. Pages prefetched in the
+# background and calls on the worker pool carry both over from the
+# thread that started them.
+_calling = threading.local()
+
+
+def _current_method():
+    return getattr(_calling, 'method', None)
+
+
+def _call_context():
+    return (getattr(_calling, 'method', None),
+            getattr(_calling, 'timeout', None))
+
+
+def _set_call_context(context):
+    _calling.method, _calling.timeout = context
+
+
+def _record_method(fn):
+    """Wraps a public method so that requests made while it runs, or
+    while the generator it returns is being consumed, are recorded with
+    its name.
+    """
+    name = fn.__name__
+
+    def call(*args, **kwargs):
+        if _current_method() is not None:
+            return fn(*args, **kwargs)
+
+        _calling.method = name
+        try:
+            result = fn(*args, **kwargs)
+        finally:
+            _calling.method = None
+
+        if inspect.isgenerator(result):
+            return _iter_recording(name, result)
+        return result
+
+    call.__name__ = name
+    call.__doc__ = fn.__doc__
+    return call
+
 
-        if response.info().getheader('Content-Type').find('application/json') != -1:
-            return json.load(fp)
+def _iter_recording(name, iterator):
+    try:
+        while True:
+            if _current_method() is not None:
+                item = next(iterator)
+            else:
+                _calling.method = name
+                try:
+                    item = next(iterator)
+                finally:
+                    _calling.method = None
+            yield item
+    finally:
+        iterator.close()
+
+
+for _cls in (Api, Batch):
+    for _name, _value in _cls.__dict__.items():
+        if not _name.startswith('_') and inspect.isfunction(_value):
+            setattr(_cls, _name, _record_method(_value))
+del _cls, _name, _value
+
+
+##### Caching #####
+
+class LRUCache(object):
+    """A thread-safe mapping that evicts its least recently used entries.
+
+    Holds at most `max_entries` entries and, if `max_bytes` is set, at
+    most that many bytes by the sizes given to `set`.
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._map = {}
+        # Circular doubly linked list of [prev, next, key, value, size]
+        self._root = root = []
+        root[:] = [root, root, None, None, 0]
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._map)
+
+    def __contains__(self, key):
+        return key in self._map
+
+    def get(self, key, default=None):
+        with self._lock:
+            link = self._map.get(key)
+            if link is None:
+                return default
+            self._unlink(link)
+            self._append(link)
+            return link[3]
+
+    def set(self, key, value, size=0):
+        with self._lock:
+            link = self._map.pop(key, None)
+            if link is not None:
+                self._unlink(link)
+                self.bytes -= link[4]
+
+            link = [None, None, key, value, size]
+            self._map[key] = link
+            self._append(link)
+            self.bytes += size
+
+            while len(self._map) > self.max_entries or \
+                    (self.max_bytes is not None and
+                     self.bytes > self.max_bytes and len(self._map) > 1):
+                oldest = self._root[1]
+                self._unlink(oldest)
+                del self._map[oldest[2]]
+                self.bytes -= oldest[4]
+
+    def pop(self, key, default=None):
+        with self._lock:
+            link = self._map.pop(key, None)
+            if link is None:
+                return default
+            self._unlink(link)
+            self.bytes -= link[4]
+            return link[3]
+
+    def items(self):
+        with self._lock:
+            return [(key, link[3]) for key, link in self._map.iteritems()]
+
+    def clear(self):
+        with self._lock:
+            self._map.clear()
+            self._root[:] = [self._root, self._root, None, None, 0]
+            self.bytes = 0
+
+    def _append(self, link):
+        root = self._root
+        last = root[0]
+        link[0], link[1] = last, root
+        last[1] = root[0] = link
+
+    def _unlink(self, link):
+        prev, next = link[0], link[1]
+        prev[1], next[0] = next, prev
+
+
+class ResponseCache(object):
+    """Caches query responses for the entities given TTLs (in seconds).
+
+    Entries are keyed by the serialized `Query`. An expired entry is
+    revalidated with If-None-Match/If-Modified-Since when the server
+    sent an ETag or Last-Modified header. An `Update` through the same
+    requester drops every entry whose query returned that entity.
+    """
+    DEFAULT_TTLS = {'users': 300, 'flows': 60}
+
+    def __init__(self, ttls=None, max_entries=1000, max_bytes=8 * 1024 * 1024):
+        self.ttls = dict(ResponseCache.DEFAULT_TTLS if ttls is None else ttls)
+        self.entries = LRUCache(max_entries, max_bytes)
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+
+    def caches(self, entity):
+        return entity in self.ttls
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None and entry.is_fresh():
+            self.hits += 1
         else:
+            self.misses += 1
+        return entry
+
+    def store(self, key, entity, include, data, size, etag=None,
+              last_modified=None):
+        entities = set(include)
+        entities.add(entity)
+        entry = _CacheEntry(data, entities, self.ttls[entity], etag,
+                            last_modified)
+        self.entries.set(key, entry, size)
+
+    def refresh(self, key, entry):
+        entry.expires = time.time() + entry.ttl
+        self.revalidations += 1
+
+    def invalidate(self, entity):
+        for key, entry in self.entries.items():
+            if entity in entry.entities:
+                self.entries.pop(key)
+
+    def clear(self):
+        self.entries.clear()
+
+
+class _CacheEntry(object):
+    __slots__ = ['data', 'entities', 'ttl', 'expires', 'etag',
+                 'last_modified']
+
+    def __init__(self, data, entities, ttl, etag, last_modified):
+        self.data = data
+        self.entities = entities
+        self.ttl = ttl
+        self.expires = time.time() + ttl
+        self.etag = etag
+        self.last_modified = last_modified
+
+    def is_fresh(self):
+        return time.time() < self.expires
+
+
+class FileCache(object):
+    """Keeps downloaded file content in a directory, up to `max_bytes`.
+
+    Content is stored under a hash of the file's id, `updated_at` and
+    `file_size`, so a changed file is downloaded again. Entries are
+    written to a temporary file and renamed into place, so readers
+    never see a partial entry. Reading an entry marks it as recently
+    used by touching its mtime, and the least recently used entries are
+    removed once the cache grows past `max_bytes`.
+    """
+
+    def __init__(self, directory, max_bytes=256 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._size = sum(size for path, size, mtime in self._entries())
+
+    @staticmethod
+    def key(file):
+        updated_at = file.updated_at
+        if updated_at is not None:
+            updated_at = format_timestamp(updated_at)
+        return hashlib.sha1('{0}:{1}:{2}'.format(
+            file.id, updated_at, file.file_size)).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        """Returns the cached content as a string, or None."""
+        fp = self.open(key)
+        if fp is None:
+            return None
+        with fp:
             return fp.read()
 
+    def open(self, key):
+        """Returns the cached content as an open file, or None."""
+        try:
+            fp = open(self.path(key), 'rb')
+        except IOError:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        try:
+            os.utime(fp.name, None)
+        except OSError:
+            pass
+        return fp
+
+    def map(self, key):
+        """Returns the cached content as a read-only `mmap`, or None.
+
+        The pages are read from the cache file as they are touched,
+        rather than copied into memory. Empty content is returned as ''.
+        """
+        fp = self.open(key)
+        if fp is None:
+            return None
+        with fp:
+            if os.fstat(fp.fileno()).st_size == 0:
+                return ''
+            return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def put(self, key, chunks):
+        """Stores the content from an iterable of strings. Returns the
+        number of bytes stored.
+        """
+        fd, temp = tempfile.mkstemp(prefix='.tmp-', dir=self.directory)
+        size = 0
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                for chunk in chunks:
+                    fp.write(chunk)
+                    size += len(chunk)
+
+            if os.name == 'nt' and os.path.exists(self.path(key)):
+                os.remove(self.path(key))
+            os.rename(temp, self.path(key))
+        except:
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
+
+        with self._lock:
+            self._size += size
+            if self._size > self.max_bytes:
+                self._evict(self.path(key))
+        return size
+
+    def pop(self, key):
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
+    def clear(self):
+        with self._lock:
+            for path, size, mtime in self._entries():
+                os.remove(path)
+            self._size = 0
+
+    def _evict(self, keep):
+        # Other processes may share the directory; count from the disk
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        self._size = sum(size for path, size, mtime in entries)
+
+        # The entry just written is kept even if it alone is too big
+        for path, size, mtime in entries:
+            if self._size <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._size -= size
+
+    def _entries(self):
+        for name in os.listdir(self.directory):
+            if name.startswith('.tmp-'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            yield path, st.st_size, st.st_mtime
+
+
+class IdentityMap(object):
+    """Shares one model object per id among all the responses of an `Api`.
+
+    Objects are held by weak reference, so they go away once nothing
+    else refers to them. When a response has a newer `updated_at` than
+    the shared object (or the model has no `updated_at`), the object is
+    refreshed in place, so earlier references see the change too.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._objects = weakref.WeakValueDictionary()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._objects)
+
+    def get(self, cls, id):
+        """Returns the shared object of model `cls` for `id`, or None."""
+        return self._objects.get((_identity_class(cls), id))
+
+    def load(self, cls, *args):
+        """Like `cls.from_json(*args)`, but returns the shared object."""
+        data = args[-1]
+        id = data.get('id')
+        if id is None:
+            return cls.from_json(*args)
+
+        key = (_identity_class(cls), id)
+        with self._lock:
+            obj = self._objects.get(key)
+            # A post whose type changed needs an instance of its new
+            # class. One loaded as a plain `Post` keeps its subclass.
+            if obj is None or not isinstance(obj, cls):
+                self.misses += 1
+                obj = self._objects[key] = cls.from_json(*args)
+                return obj
+
+            self.hits += 1
+            if self._is_newer(obj, data.get('updated_at')):
+                obj.refresh(*args)
+            return obj
+
+    def clear(self):
+        with self._lock:
+            self._objects.clear()
+
+    def _is_newer(self, obj, updated_at):
+        current = getattr(obj, 'updated_at', None)
+        if updated_at is None or current is None:
+            return True
+        return parse_timestamp(updated_at) > current
+
+
+_IDENTITY_CLASSES = {}
+
+def _identity_class(cls):
+    # Post subclasses share their ids with Post
+    root = _IDENTITY_CLASSES.get(cls)
+    if root is None:
+        root = cls
+        for klass in cls.__mro__:
+            if _Model in klass.__bases__:
+                root = klass
+        _IDENTITY_CLASSES[cls] = root
+    return root
+
+
+##### Concurrency #####
+
+class WorkerPool(object):
+    """A bounded set of daemon threads that run submitted calls.
+
+    Threads are started as work arrives, up to `max_workers`.
+    """
+
+    def __init__(self, max_workers=8):
+        self.max_workers = max_workers
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        self._queue.put((future, fn, args, kwargs, _call_context()))
+
+        with self._lock:
+            if len(self._threads) < self.max_workers:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+        return future
+
+    def map(self, fn, items, timeout=None):
+        futures = [self.submit(fn, item) for item in items]
+        return [future.result(timeout) for future in futures]
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            threads, self._threads = self._threads, []
+
+        for thread in threads:
+            self._queue.put(None)
+
+        if wait:
+            for thread in threads:
+                if thread is not threading.current_thread():
+                    thread.join()
+
+    def _work(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                return
+
+            future, fn, args, kwargs, context = task
+            _set_call_context(context)
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except Exception:
+                future.set_exception(sys.exc_info())
+            finally:
+                _set_call_context((None, None))
+
+
+class Future(object):
+    """The result of a call running on a `WorkerPool`."""
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        if not self._done.wait(timeout) and not self._done.is_set():
+            raise Timeout("call did not complete in {0} seconds"
+                          .format(timeout))
+
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+
+        return self._result
+
+    def exception(self, timeout=None):
+        try:
+            self.result(timeout)
+        except Timeout:
+            raise
+        except Exception as error:
+            return error
+        return None
+
+    def add_done_callback(self, fn):
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exc_info):
+        self._exc_info = exc_info
+        self._finish()
+
+    def _finish(self):
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+
+        for fn in callbacks:
+            fn(self)
+
+
+class _Descending(object):
+    """Reverses the ordering of a value, for newest-first heaps."""
+    __slots__ = ['value']
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return self.value > other.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+##### Timestamps #####
+
+_TIMESTAMP_RE = re.compile(
+    r'(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d):(\d\d)(?:\.(\d{1,6})\d*)?'
+    r'(Z|[+-]\d\d:?\d\d)?$')
+
+def parse_timestamp(value, memo=None):
+    """Parses an ISO-8601 timestamp into a naive UTC `datetime`.
+
+    Timestamps with a UTC offset are converted to UTC. If `memo` is a
+    dict, parsed values are looked up in and added to it.
+    """
+    if memo is not None:
+        parsed = memo.get(value)
+        if parsed is None:
+            parsed = memo[value] = parse_timestamp(value)
+        return parsed
+
+    # Fast path for the server's usual layout, '2010-03-04T12:34:56Z'
+    if len(value) == 20 and value[10] == 'T' and value[19] == 'Z':
+        try:
+            return datetime(int(value[0:4]), int(value[5:7]),
+                            int(value[8:10]), int(value[11:13]),
+                            int(value[14:16]), int(value[17:19]))
+        except ValueError:
+            pass
+
+    match = _TIMESTAMP_RE.match(value)
+    if match is None:
+        raise ValueError("Invalid timestamp: {0!r}".format(value))
+
+    year, month, day, hour, minute, second, fraction, zone = match.groups()
+    parsed = datetime(int(year), int(month), int(day), int(hour),
+                      int(minute), int(second),
+                      int(fraction.ljust(6, '0')) if fraction else 0)
+
+    if zone and zone != 'Z':
+        zone = zone.replace(':', '')
+        offset = timedelta(hours=int(zone[1:3]), minutes=int(zone[3:5]))
+        parsed = parsed - offset if zone[0] == '+' else parsed + offset
+
+    return parsed
+
+def parse_many(values, memo=None):
+    """Parses a list of timestamps, e.g. the `created_at` values of a page
+    of records. Repeated values are parsed only once. `None` and empty
+    values are returned as `None`.
+    """
+    if memo is None:
+        memo = {}
+
+    parsed = []
+    append = parsed.append
+    get = memo.get
+    for value in values:
+        result = get(value)
+        if result is None and value:
+            result = memo[value] = parse_timestamp(value)
+        append(result)
+    return parsed
+
+def format_timestamp(value):
+    """Formats a `datetime` (naive values are taken as UTC), or seconds
+    since the epoch, as an ISO-8601 UTC timestamp.
+    """
+    if not isinstance(value, datetime):
+        value = datetime(1970, 1, 1) + timedelta(seconds=value)
+    elif value.utcoffset() is not None:
+        value = value.replace(tzinfo=None) - value.utcoffset()
+
+    if value.microsecond:
+        return value.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+    return value.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
 ##### Model Classes #####        
 
-class Flow(object):
+class _Lazy(object):
+    """A model attribute decoded from its raw JSON value on first read.
+
+    The raw value is kept in `_raw_<name>` and the decoded value is
+    cached in `_<name>`. Assigning to the attribute sets the decoded
+    value directly.
+    """
+
+    def __init__(self, name, decode=None):
+        self.raw = '_raw_' + name
+        self.cached = '_' + name
+        self.decode = decode
+
+    def __get__(self, obj, type=None):
+        if obj is None:
+            return self
+
+        try:
+            return getattr(obj, self.cached)
+        except AttributeError:
+            value = getattr(obj, self.raw, None)
+            if value and self.decode is not None:
+                value = self.decode(value)
+            setattr(obj, self.cached, value)
+            return value
+
+    def __set__(self, obj, value):
+        setattr(obj, self.cached, value)
+
+
+class _Model(object):
+    """Base for model classes, with a generated `from_json`."""
+    __slots__ = ('__weakref__',)
+    # Attributes filled in from other records of a response, which
+    # `refresh` keeps until a response supplies them again
+    _RELATIONS = ()
+
+    @classmethod
+    def from_json(cls, *args):
+        """Builds a model from its JSON dict: `from_json([requester,] data)`.
+
+        The constructor for each class is generated on first use from
+        `_VALID_ATTRIBUTES` and the defaults of its `__init__`, and calls
+        `__init__` positionally with the values found in the data.
+        """
+        build = _BUILDERS.get(cls)
+        if build is None:
+            build = _BUILDERS[cls] = _generate_builder(cls)
+        return build(cls, *args)
+
+    def refresh(self, *args):
+        """Re-initializes this model in place from `([requester,] data)`."""
+        cls = type(self)
+        assign = _ASSIGNERS.get(cls)
+        if assign is None:
+            assign = _ASSIGNERS[cls] = _generate_builder(cls, assign=True)
+
+        # Drop decoded values so lazy attributes read the new data
+        for klass in cls.__mro__:
+            for attr in vars(klass).itervalues():
+                if isinstance(attr, _Lazy):
+                    try:
+                        delattr(self, attr.cached)
+                    except AttributeError:
+                        pass
+
+        kept = [(name, getattr(self, name)) for name in self._RELATIONS]
+        assign(self, *args)
+        for name, value in kept:
+            setattr(self, name, value)
+        return self
+
+
+_BUILDERS = {}
+_ASSIGNERS = {}
+
+def _generate_builder(cls, assign=False):
+    spec = inspect.getargspec(cls.__init__)
+    names = spec.args[1:]
+    defaults = spec.defaults or ()
+    required = names[:len(names) - len(defaults)]
+
+    namespace = {}
+    args = list(required)
+    for i, name in enumerate(names[len(required):]):
+        namespace['_default{0}'.format(i)] = defaults[i]
+        if name in cls._VALID_ATTRIBUTES:
+            args.append("get('{0}', _default{1})".format(name, i))
+        else:
+            args.append('_default{0}'.format(i))
+
+    # The assign variant calls __init__ again on an existing instance
+    target, call = ('obj', 'obj.__init__') if assign else ('cls', 'cls')
+    source = 'def build({0}, {1}data):\n' \
+        '    get = data.get\n' \
+        '    return {2}({3})\n'.format(
+        target, ''.join(name + ', ' for name in required), call,
+        ', '.join(args))
+
+    exec source in namespace
+    return namespace['build']
+
+
+class Flow(_Model):
+    __slots__ = ['id', 'name', 'email_address', '_raw_created_at', '_created_at',
+                 '_raw_updated_at', '_updated_at', 'is_default', 'owner_name',
+                 'quota_percentage', 'quota_count', 'rss_url', 'invitations',
+                 'owner_id']
+    _RELATIONS = ('invitations', 'owner_id')
     _VALID_ATTRIBUTES = set([
             'id',
             'name',
@@ -582,10 +4244,13 @@ class Flow(object):
             'updated_at',
             'default_channel',
             'owner_name',
-            'quota_precentage',
+            'quota_percentage',
             'quota_count',
             'rss_url'
             ])
+    created_at = _Lazy('created_at', parse_timestamp)
+    updated_at = _Lazy('updated_at', parse_timestamp)
+
     def __init__(self,
                  id=None, 
                  name=None, 
@@ -600,8 +4265,8 @@ class Flow(object):
         self.id = id
         self.name = name
         self.email_address = email_address
-        self.created_at = iso8601.parse(created_at) if created_at else None
-        self.updated_at = iso8601.parse(updated_at) if updated_at else None
+        self._raw_created_at = created_at
+        self._raw_updated_at = updated_at
         self.is_default = default_channel
         self.owner_name = owner_name
         self.quota_percentage = quota_percentage
@@ -625,13 +4290,11 @@ class Flow(object):
     def __str__(self):
         return "Flow[{0.id}]: {0.name}".format(self)
 
-    @classmethod
-    def from_json(cls, data):
-        return cls(**dict([(str(k),v) for k,v in data.iteritems() 
-                           if k in cls._VALID_ATTRIBUTES]))
     
 
-class User(object):
+class User(_Model):
+    __slots__ = ['id', 'login', 'first_name', 'last_name', 'email', 'avatar_url',
+                 'is_online', 'role', 'time_zone']
     _VALID_ATTRIBUTES = set([
             'avatar_url',
             'email',
@@ -679,13 +4342,11 @@ class User(object):
     def __str__(self):
         return "User[{0.id}]: {0.first_name} {0.last_name} <{0.email}>".format(self)
 
-    @classmethod
-    def from_json(cls, data):
-        return cls(**dict([(str(k),v) for k,v in data.iteritems() 
-                           if k in cls._VALID_ATTRIBUTES]))
 
 
 class Invitation(object):
+    __slots__ = ['id', 'email']
+
     def __init__(self, id, email):
         self.id = id
         self.email = email
@@ -697,7 +4358,11 @@ class Invitation(object):
         return "Invitation[{0.id}]: {0.email}".format(self)
 
 
-class File(object):
+class File(_Model):
+    __slots__ = ['__requester', '__url', 'id', 'file_name', 'file_size', 'post_id',
+                 'content_type', 'is_image', '_raw_meta_data', '_meta_data',
+                 'width', 'height', 'thumbnail_url', '_raw_created_at',
+                 '_created_at', '_raw_updated_at', '_updated_at']
     _VALID_ATTRIBUTES = set([
             'content_type',
             'created_at',
@@ -709,10 +4374,15 @@ class File(object):
             'post_id',
             'thumbnail_url',
             'meta_data',
+            'updated_at',
             'url',
             'width'
             ])
 
+    meta_data = _Lazy('meta_data', _decode_json)
+    created_at = _Lazy('created_at', parse_timestamp)
+    updated_at = _Lazy('updated_at', parse_timestamp)
+
     def __init__(self,
                  requester,
                  id=None,
@@ -737,19 +4407,111 @@ class File(object):
         self.post_id = post_id
         self.content_type = content_type
         self.is_image = is_image
-        self.meta_data = None if meta_data is None else json.loads(meta_data)
+        self._raw_meta_data = meta_data
         self.width = int(width) if width else None
         self.height = int(height) if height else None
         self.thumbnail_url = thumbnail_url
-        self.created_at = iso8601.parse(created_at) if created_at else None
-        self.updated_at = iso8601.parse(updated_at) if updated_at else None
+        self._raw_created_at = created_at
+        self._raw_updated_at = updated_at
 
     @property
     def url(self):
         return self.__requester.create_url(self.__url)
 
     def retrieve(self):
-        return self.__requester.content_request(self.__url)
+        cache = self.__requester.file_cache
+        if cache is None:
+            return self.__requester.content_request(self.__url)
+
+        key = cache.key(self)
+        data = cache.get(key)
+        if data is None:
+            chunks = []
+            cache.put(key, self._collect(chunks))
+            data = ''.join(chunks)
+        return data
+
+    def retrieve_mapped(self):
+        """Returns the content as a read-only `mmap` of the requester's
+        `FileCache` entry, downloading it into the cache first if needed.
+        """
+        cache = self.__requester.file_cache
+        if cache is None:
+            raise ValueError("retrieve_mapped needs a file_cache")
+
+        key = cache.key(self)
+        data = cache.map(key)
+        if data is None:
+            cache.put(key, self.iter_content())
+            data = cache.map(key)
+        return data
+
+    def _collect(self, chunks):
+        for chunk in self.iter_content():
+            chunks.append(chunk)
+            yield chunk
+
+    def iter_content(self, chunk_size=Requester.CHUNK_SIZE, offset=0):
+        """Yields the decompressed file content in chunks.
+
+        If `offset` is given the download starts at that byte.
+        """
+        response = self.__requester.content_stream(self.__url, offset)
+
+        skip = 0
+        if offset and response.status != httplib.PARTIAL_CONTENT:
+            # The server ignored the range; drop the leading bytes
+            skip = offset
+
+        for chunk in self.__requester.iter_response(response, chunk_size):
+            if skip:
+                dropped = min(skip, len(chunk))
+                chunk = chunk[dropped:]
+                skip -= dropped
+            if chunk:
+                yield chunk
+
+    def retrieve_to(self, path_or_fileobj, chunk_size=Requester.CHUNK_SIZE,
+                    resume=False):
+        """Writes the file content to a path or file object.
+
+        With `resume=True` an existing partial download is continued
+        from its current size (or a file object's current position).
+        Returns the total number of bytes in the destination.
+        """
+        fp = path_or_fileobj
+        offset = 0
+
+        if isinstance(path_or_fileobj, basestring):
+            if resume and os.path.exists(path_or_fileobj):
+                fp = open(path_or_fileobj, 'r+b')
+                fp.seek(0, os.SEEK_END)
+                offset = fp.tell()
+            else:
+                fp = open(path_or_fileobj, 'wb')
+        elif resume:
+            offset = fp.tell()
+
+        try:
+            if resume and self.file_size and offset >= int(self.file_size):
+                return offset
+
+            response = self.__requester.content_stream(self.__url, offset)
+
+            if offset and response.status != httplib.PARTIAL_CONTENT:
+                # The server ignored the range; start over
+                fp.seek(fp.tell() - offset)
+                fp.truncate()
+                offset = 0
+
+            for chunk in self.__requester.iter_response(response, chunk_size):
+                fp.write(chunk)
+                offset += len(chunk)
+        finally:
+            if fp is not path_or_fileobj:
+                fp.close()
+
+        return offset
 
     def __hash__(self):
         return self.id.__hash__()
@@ -767,13 +4529,13 @@ class File(object):
         return "File[{0.id}]: {0.name}".format(self)
 
 
-    @classmethod
-    def from_json(cls, requester, data):
-        return cls(requester, **dict([(str(k),v) for k,v in data.iteritems() 
-                                      if k in cls._VALID_ATTRIBUTES]))
 
     
-class Comment(object):
+class Comment(_Model):
+    __slots__ = ['id', 'flow_id', 'flow_name', 'reply_to', 'content', 'user_id',
+                 '_raw_created_at', '_created_at', '_raw_updated_at',
+                 '_updated_at', 'user']
+    _RELATIONS = ('user',)
     _VALID_ATTRIBUTES = set([
             'content',
             'created_at',
@@ -784,6 +4546,9 @@ class Comment(object):
             'updated_at',
             'user_id'
             ])
+    created_at = _Lazy('created_at', parse_timestamp)
+    updated_at = _Lazy('updated_at', parse_timestamp)
+
     def __init__(self,
                  id=None,
                  flow_id=None,
@@ -798,9 +4563,10 @@ class Comment(object):
         self.flow_name = flow_name
         self.reply_to = reply_to
         self.content = content
-        self.created_at = iso8601.parse(created_at) if created_at else None
-        self.updated_at = iso8601.parse(updated_at) if updated_at else None
+        self._raw_created_at = created_at
+        self._raw_updated_at = updated_at
         self.user_id = user_id
+        self.user = None
 
     def __hash__(self):
         return self.id.__hash__()
@@ -817,14 +4583,15 @@ class Comment(object):
     def __str__(self):
         return "Comment[{0.id}]: {0.user_id}".format(self)
 
-    @classmethod
-    def from_json(cls, data):
-        return cls(**dict([(str(k),v) for k,v in data.iteritems() 
-                           if k in cls._VALID_ATTRIBUTES]))
 
 ##### Posts #####
 
-class Post(object):
+class Post(_Model):
+    __slots__ = ['id', 'flow_id', 'flow_name', 'post_type', '_raw_content',
+                 '_content', 'star', '_raw_created_at', '_created_at',
+                 '_raw_updated_at', '_updated_at', 'reply_ids', 'file_ids',
+                 'user_id', 'files', 'comments', 'user']
+    _RELATIONS = ('files', 'comments', 'user')
     _VALID_ATTRIBUTES = set([
             'content',
             'created_at',
@@ -839,6 +4606,10 @@ class Post(object):
             'user_id'
             ])
 
+    content = _Lazy('content')
+    created_at = _Lazy('created_at', parse_timestamp)
+    updated_at = _Lazy('updated_at', parse_timestamp)
+
     def __init__(self,
                  id=None,
                  flow_id=None,
@@ -855,16 +4626,17 @@ class Post(object):
         self.flow_id = flow_id
         self.flow_name = flow_name
         self.post_type = post_type
-        self.content = content
+        self._raw_content = content
         self.star = star
-        self.created_at = iso8601.parse(created_at) if created_at else None
-        self.updated_at = iso8601.parse(updated_at) if updated_at else None
+        self._raw_created_at = created_at
+        self._raw_updated_at = updated_at
         self.reply_ids = reply_ids or []
         self.file_ids = file_ids or []
         self.user_id = user_id
 
         self.files = list()
         self.comments = list()
+        self.user = None
 
     def is_map(self):
         return False
@@ -905,16 +4677,12 @@ class Post(object):
     def __str__(self):
         return "Post[{0.id}]: {0.post_type} {0.user_id}".format(self)
 
-    @classmethod
-    def from_json(cls, data):
-        return cls(**dict([(str(k),v) for k,v in data.iteritems() 
-                           if k in cls._VALID_ATTRIBUTES]))
 
 
 class MapPost(Post):
-    def __init__(self, **kwargs):
-        Post.__init__(self, **kwargs)
-        self.content = eval(self.content)
+    __slots__ = ()
+
+    content = _Lazy('content', eval)
 
     def get_address(self):
         return self.content['address']
@@ -926,10 +4694,14 @@ class MapPost(Post):
         return True
 
 class FilePost(Post):
+    __slots__ = ()
+
     def is_file(self):
         return True
 
 class _EmbedPost(Post):
+    __slots__ = ()
+
     def is_embed(self):
         return self.content is not None
 
@@ -939,33 +4711,37 @@ class _EmbedPost(Post):
         return re.search(r'="(http.*?)"', self.content).group(1)
 
 class ImagePost(_EmbedPost):
+    __slots__ = ()
+
     def is_image(self):
         return True
 
 
 class VideoPost(_EmbedPost):
+    __slots__ = ()
+
     def is_video(self):
         return False
 
 class HTMLPost(Post):
+    __slots__ = ()
+
     def is_html(self):
         return True
 
 
 class EmailPost(Post):
-    def __init__(self, **kwargs):
-        Post.__init__(self, **kwargs)
-        self.__msg = None
-    
+    __slots__ = ['__msg']
+
     @property
     def msg(self):
-        if not self.__msg:
+        if not getattr(self, '_EmailPost__msg', None):
             for f in self.files:
                 if f.meta_data and \
                         f.meta_data.get('attachment_type') == 'email_message':
                     self.__msg = f
                     break
-        return self.__msg
+        return getattr(self, '_EmailPost__msg', None)
 
     def get_sender(self):
         return self.msg.meta_data['sender_display_name']
@@ -983,19 +4759,17 @@ class EmailPost(Post):
         return True
 
 class EventPost(Post):
-    def __init__(self, **kwargs):
-        Post.__init__(self, **kwargs)
-        self.__event = None
-    
+    __slots__ = ['__event']
+
     @property
     def event(self):
-        if not self.__event:
+        if not getattr(self, '_EventPost__event', None):
             for f in self.files:
                 if f.meta_data and \
                         f.meta_data.get('attachment_type') == 'event':
                     self.__event = f
                     break
-        return self.__event
+        return getattr(self, '_EventPost__event', None)
 
     def get_ics_content(self):
         return self.event.retrieve()
@@ -1013,3 +4787,33 @@ class InvalidRequest(Exception):
 
 class ServiceError(Exception):
     pass
+
+class Timeout(Exception):
+    pass
+
+class BatchError(Exception):
+    """Raised when an update of a `Batch` fails.
+
+    `error` is the exception the update raised, and `pending` maps each
+    entity to the records that were not sent, which stay queued.
+    """
+
+    def __init__(self, error, pending):
+        Exception.__init__(self, "{0} records were not sent: {1}".format(
+                sum(len(records) for records in pending.itervalues()),
+                error))
+        self.error = error
+        self.pending = pending
+
+class UploadError(Exception):
+    """Raised when some groups of `upload_files` could not be sent.
+
+    `post` is the post with the files that were created, or None, and
+    `failed` lists (sources, exception) for each group that failed.
+    """
+
+    def __init__(self, error, post, failed):
+        Exception.__init__(self, "{0} of the upload groups failed: {1}"
+                           .format(len(failed), error))
+        self.post = post
+        self.failed = failed